@@ -0,0 +1,100 @@
+import glob
+import os
+import random
+import re
+from datetime import date, timedelta
+
+# Родительный падеж месяцев — так Яндекс пишет даты отзывов («12 марта 2024»)
+RU_MONTHS_GENITIVE = [
+    "января", "февраля", "марта", "апреля", "мая", "июня",
+    "июля", "августа", "сентября", "октября", "ноября", "декабря",
+]
+
+WORDS = (
+    "вкусно уютно быстро дорого дёшево персонал официант кофе десерт завтрак обед ужин музыка зал "
+    "интерьер порции меню вернусь рекомендую обслуживание долго ждали отлично неплохо средне шумно "
+    "чисто атмосфера бариста выпечка паста салат суп цены бронь веранда парковка уровень качество"
+).split()
+
+STREETS = ["Тверская", "Арбат", "Покровка", "Маросейка", "Мясницкая", "Пятницкая", "Сретенка", "Неглинная"]
+NAME_PREFIXES = ["Кафе", "Кофейня", "Бистро", "Ресторан", "Пекарня", "Бар"]
+NAME_WORDS = ["Лето", "Маяк", "Сад", "Дом", "Гости", "Зерно", "Облако", "Тесто", "Полка", "Берег"]
+
+# Ссылка на организацию в дампе страницы поиска: /org/<slug>/<id>/
+SEED_ORG_RE = re.compile(r"/org/([^/\"'?#]+)/(\d+)")
+
+# Организации из сохранённых страниц поиска (pre_check_page_*.html): реальные slug и id
+def load_seed_orgs(seed_dir):
+    orgs = {}
+    for path in sorted(glob.glob(os.path.join(seed_dir, "pre_check_page_*.html"))):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for slug, org_id in SEED_ORG_RE.findall(f.read()):
+                orgs.setdefault(org_id, slug)
+    return [(slug, org_id) for org_id, slug in orgs.items()]
+
+# Последний сохранённый дамп капчи (captcha_page_*.html), если в нём есть кнопка CheckboxCaptcha
+def load_captcha_template(seed_dir):
+    for path in sorted(glob.glob(os.path.join(seed_dir, "captcha_page_*.html")), reverse=True):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            html = f.read()
+        if "CheckboxCaptcha-Button" in html:
+            return html
+    return None
+
+def _review(rng, number, today):
+    return {
+        "id": f"r{number}",
+        "author": f"Гость {rng.randint(1, 10 ** 6)}",
+        "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 40))).capitalize() + ".",
+        "rating": rng.choices([1, 2, 3, 4, 5], weights=[1, 1, 2, 4, 6])[0],
+        "date": today - timedelta(days=rng.randint(0, 730)),
+    }
+
+# Детерминированный набор заведений с отзывами; seed_dir подмешивает реальные id из дампов
+def generate_venues(count, seed=1, reviews_max=60, bbox=(37.32, 55.55, 37.95, 55.92), seed_dir=None, today=None):
+    rng = random.Random(seed)
+    today = today or date.today()
+    seeds = load_seed_orgs(seed_dir) if seed_dir else []
+    lon_min, lat_min, lon_max, lat_max = bbox
+    venues = []
+    review_number = 0
+    for i in range(count):
+        if i < len(seeds):
+            slug, org_id = seeds[i]
+            name = slug.replace("_", " ").capitalize()
+        else:
+            org_id = str(1000000000 + i)
+            slug = f"venue_{i}"
+            name = f"{rng.choice(NAME_PREFIXES)} «{rng.choice(NAME_WORDS)}» {i}"
+        reviews = []
+        for _ in range(rng.randint(0, reviews_max)):
+            review_number += 1
+            reviews.append(_review(rng, review_number, today))
+        reviews.sort(key=lambda review: review["date"], reverse=True)
+        venues.append({
+            "id": org_id,
+            "slug": slug,
+            "name": name,
+            "address": f"Москва, {rng.choice(STREETS)} улица, {rng.randint(1, 120)}",
+            "phone": f"+7 (495) {rng.randint(100, 999)}-{rng.randint(10, 99)}-{rng.randint(10, 99)}",
+            "rating": round(rng.uniform(3.0, 5.0), 1),
+            "rate_count": rng.randint(len(reviews), len(reviews) * 3 + 5000),
+            "site": f"{slug}.example.ru",
+            "average_bill": f"{rng.choice([500, 800, 1000, 1500])}–{rng.choice([2000, 2500, 3000])} ₽",
+            "lon": rng.uniform(lon_min, lon_max),
+            "lat": rng.uniform(lat_min, lat_max),
+            "reviews": reviews,
+            "next_review": review_number,
+        })
+    return venues
+
+# Новые отзывы между проходами: эмуляция того, что заведения получили свежие отзывы
+def add_new_reviews(venues, per_venue, seed=1, today=None):
+    rng = random.Random(seed)
+    today = today or date.today()
+    for venue in venues:
+        for _ in range(per_venue):
+            venue["next_review"] += 1
+            review = _review(rng, f"{venue['id']}-{venue['next_review']}", today)
+            review["date"] = today
+            venue["reviews"].insert(0, review)
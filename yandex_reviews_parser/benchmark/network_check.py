@@ -0,0 +1,107 @@
+import argparse
+import glob
+import json
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from main import is_last_review_page, map_network_org, map_network_reviews, parse_review_date
+
+# Проверка разбора ответов API на записанных ответах Яндекс.Карт, а не на JSON заглушки.
+# Фикстура fetchReviews/search с парным *.expected.json сверяется поле в поле;
+# ответ без ожидаемого результата (например, снятый через NETWORK_DUMP_DIR) проверяется на то,
+# что маппер вообще нашёл поля: пустые авторы, оценки и даты означают переименованное поле в API.
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, "network_fixtures")
+
+def _load(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _kind(payload):
+    data = payload.get("data") or {}
+    if "reviews" in data:
+        return "reviews"
+    if "items" in data:
+        return "org"
+    return None
+
+def _compare(payload, kind, expected):
+    problems = []
+    if kind == "reviews":
+        actual = {"reviews": map_network_reviews(payload), "last_page": is_last_review_page(payload)}
+        if actual["last_page"] != expected["last_page"]:
+            problems.append(f"last_page: {actual['last_page']} вместо {expected['last_page']}")
+        if len(actual["reviews"]) != len(expected["reviews"]):
+            problems.append(f"отзывов {len(actual['reviews'])} вместо {len(expected['reviews'])}")
+        for index, (got, want) in enumerate(zip(actual["reviews"], expected["reviews"])):
+            for field in want:
+                if got.get(field) != want[field]:
+                    problems.append(f"отзыв {index}, {field}: {got.get(field)!r} вместо {want[field]!r}")
+    else:
+        got = map_network_org(payload, expected["url"])
+        for field in sorted(set(got) | set(expected["org"])):
+            if got.get(field) != expected["org"].get(field):
+                problems.append(f"{field}: {got.get(field)!r} вместо {expected['org'].get(field)!r}")
+    return problems
+
+# Проверка ответа без ожидаемого результата: каждое поле должно найтись хотя бы в одной записи
+def _sanity(payload, kind):
+    problems = []
+    if kind == "reviews":
+        reviews = map_network_reviews(payload)
+        if not reviews:
+            problems.append("в ответе нет отзывов")
+        for field in ("text", "author", "rating", "date"):
+            if reviews and all(review[field] == "N/A" for review in reviews):
+                problems.append(f"поле {field} не найдено ни в одном отзыве")
+        for index, review in enumerate(reviews):
+            if review["rating"] != "N/A" and review["rating"] not in ("1", "2", "3", "4", "5"):
+                problems.append(f"отзыв {index}: оценка {review['rating']!r}")
+            if review["date"] != "N/A" and parse_review_date(review["date"]) is None:
+                problems.append(f"отзыв {index}: дата {review['date']!r} не разбирается")
+    else:
+        items = (payload.get("data") or {}).get("items") or []
+        if not items or not items[0].get("id"):
+            return ["в ответе нет организаций"]
+        org = map_network_org(payload, f"/org/{items[0]['id']}/")
+        for field in ("name", "address", "rate", "rate_count"):
+            if field not in org:
+                problems.append(f"поле {field} не найдено")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка разбора записанных ответов API Яндекс.Карт")
+    parser.add_argument("paths", nargs="*", help="JSON-ответы или шаблоны, например 'dumps/*.json'")
+    args = parser.parse_args()
+
+    patterns = args.paths or [os.path.join(FIXTURES_DIR, "*.json")]
+    checked = failed = 0
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            if path.endswith(".expected.json"):
+                continue
+            payload = _load(path)
+            kind = _kind(payload)
+            if kind is None:
+                print(f"Пропуск {path}: не ответ fetchReviews или search")
+                continue
+            expected_path = path[:-len(".json")] + ".expected.json"
+            if os.path.exists(expected_path):
+                problems = _compare(payload, kind, _load(expected_path))
+            else:
+                problems = _sanity(payload, kind)
+            checked += 1
+            if problems:
+                failed += 1
+                print(f"Расхождение в {path}:")
+                for problem in problems:
+                    print(f"  {problem}")
+
+    print(f"Проверено ответов: {checked}, с расхождениями: {failed}")
+    sys.exit(1 if failed or not checked else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import extraction
+from fixtures import generate_venues
+from stub_server import render_org_page
+
+# Сверка движков разбора: lxml должен давать те же поля заведения, что и BeautifulSoup.
+# Страницы — сохранённые HTML-файлы (дампы парсера, страницы организаций) и страницы заглушки.
+
+def _pages(paths, venues):
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, encoding="utf-8", errors="replace") as f:
+                yield path, f.read()
+    for venue in generate_venues(venues):
+        yield f"stub:{venue['id']}", render_org_page(venue)
+
+def _timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description="Сверка движков разбора lxml и BeautifulSoup")
+    parser.add_argument("paths", nargs="*", help="HTML-файлы или шаблоны, например 'pages/*.html'")
+    parser.add_argument("--venues", type=int, default=50, help="Сколько страниц заглушки добавить к сверке")
+    args = parser.parse_args()
+
+    timings = {engine: 0.0 for engine in extraction.ENGINES}
+    pages = mismatches = 0
+    for name, html in _pages(args.paths, args.venues):
+        pages += 1
+        results = {}
+        for engine in extraction.ENGINES:
+            results[engine], seconds = _timed(extraction.parse_establishment_fields, name, html, engine)
+            timings[engine] += seconds
+        if results["lxml"] != results["bs4"]:
+            mismatches += 1
+            print(f"Расхождение: {name}")
+            for engine, org in results.items():
+                print(f"  {engine}: {org}")
+    print(f"Страниц: {pages}, расхождений: {mismatches}")
+    for engine, seconds in timings.items():
+        print(f"  {engine}: {seconds * 1000 / max(pages, 1):.2f} мс на страницу")
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PARSER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, PARSER_DIR)
+
+from fixtures import add_new_reviews, generate_venues, load_captcha_template
+from main import db_params, log_print
+from stub_server import StubState, start_stub_server
+
+# Прогон парсера (main.py) против локальной заглушки: скорость, память браузеров, задержка записи в базу.
+# Результаты дописываются в results/results.jsonl и сравниваются с прошлым прогоном того же сценария.
+
+# Окружение парсера по умолчанию; переопределяется через --env
+DEFAULT_ENV = {
+    "ENABLE_PARSER": "true",
+    "CRAWL_ROLE": "all",
+    "TITLE": "кафе",
+    "METRICS_PORT": "0",
+    "MAX_WORKERS": "3",
+    "PACING_MIN_DELAY": "0.2",
+    "SNIPPET_WAIT_TIMEOUT": "2",
+    "QUEUE_IDLE_EXIT": "5",
+    "CRAWL_FRESHNESS_HOURS": "0",
+}
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Снимок /proc: pid -> (ppid, имя процесса, RSS в байтах)
+def _proc_table():
+    table = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                stat = f.read()
+            with open(f"/proc/{name}/statm") as f:
+                resident = int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+        comm = stat[stat.index("(") + 1:stat.rindex(")")]
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        table[int(name)] = (ppid, comm, resident)
+    return table
+
+def _descendants(table, root):
+    children = {}
+    for pid, (ppid, _, _) in table.items():
+        children.setdefault(ppid, []).append(pid)
+    result, stack = [], [root]
+    while stack:
+        pid = stack.pop()
+        result.append(pid)
+        stack.extend(children.get(pid, []))
+    return result
+
+def _peak_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+# Фоновый замер памяти: пик процесса парсера и пик суммарного RSS дерева каждого браузера (chromedriver + Chrome)
+class RssSampler:
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.parser_peak = 0
+        self.browser_peak = 0
+        self.browsers = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.parser_peak = max(self.parser_peak, _peak_rss(self.pid))
+            table = _proc_table()
+            for pid in _descendants(table, self.pid):
+                if table.get(pid, (0, "", 0))[1] != "chromedriver":
+                    continue
+                self.browsers.add(pid)
+                tree_rss = sum(table[child][2] for child in _descendants(table, pid) if child in table)
+                self.browser_peak = max(self.browser_peak, tree_rss)
+            self._stop.wait(self.interval)
+
+# Отдельная база для бенчмарка: создаётся при необходимости и очищается перед первым проходом
+def prepare_database(name):
+    if name == db_params["database"]:
+        raise SystemExit(f"База бенчмарка совпадает с рабочей ({name}), укажите другую через --db.")
+    conn = psycopg2.connect(**dict(db_params, database="postgres"))
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+        if cursor.fetchone() is None:
+            cursor.execute(f'CREATE DATABASE "{name}"')
+    conn.close()
+    conn = psycopg2.connect(**dict(db_params, database=name))
+    with conn, conn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+    conn.close()
+
+def count_rows(name):
+    conn = psycopg2.connect(**dict(db_params, database=name))
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT (SELECT count(*) FROM establishment_data), (SELECT count(*) FROM reviews)")
+            return cursor.fetchone()
+    finally:
+        conn.close()
+
+def _metric(summary, key, field=None):
+    value = summary.get("metrics", {}).get(key)
+    if field and isinstance(value, dict):
+        return value.get(field)
+    return value or 0
+
+# Один проход парсера: запуск main.py, замер памяти, разбор сводки метрик
+def run_pass(env, label, number, timeout):
+    os.makedirs(os.path.join(BENCH_DIR, "results"), exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    summary_path = os.path.join(BENCH_DIR, "results", f"metrics_{stamp}_{label}_{number}.json")
+    log_path = os.path.join(BENCH_DIR, "results", f"run_{stamp}_{label}_{number}.log")
+    env = dict(env, METRICS_SUMMARY_PATH=summary_path)
+    started = time.monotonic()
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        process = subprocess.Popen(
+            [sys.executable, "main.py"], cwd=PARSER_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT
+        )
+        sampler = RssSampler(process.pid)
+        sampler.start()
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            log_print(f"Проход {number} не уложился в {timeout} с, останавливаем.")
+            process.terminate()
+            process.wait()
+        finally:
+            sampler.stop()
+    wall = time.monotonic() - started
+    with open(summary_path, encoding="utf-8") as f:
+        summary = json.load(f)
+
+    venues_ok = _metric(summary, 'parser_venues_total{outcome="ok"}')
+    reviews = _metric(summary, "parser_reviews_total")
+    collection = _metric(summary, 'parser_stage_wall_seconds{stage="link_collection"}', "sum") or 0
+    # Скорость обработки считается без сбора ссылок: он зависит от выдачи, а не от обработки заведений
+    processing = max(summary.get("uptime_seconds", wall) - collection, 1e-9)
+    stages = {
+        key[key.index('"') + 1:key.rindex('"')]: value
+        for key, value in summary.get("metrics", {}).items()
+        if key.startswith("parser_stage_wall_seconds{")
+    }
+    return {
+        "exit_code": process.returncode,
+        "wall_seconds": round(wall, 3),
+        "link_collection_seconds": round(collection, 3),
+        "venues_ok": venues_ok,
+        "venues_error": _metric(summary, 'parser_venues_total{outcome="error"}'),
+        "venues_per_min": round(venues_ok * 60 / processing, 3),
+        "reviews": reviews,
+        "reviews_per_second": round(reviews / processing, 3),
+        "db_write_avg_seconds": _metric(summary, 'parser_stage_wall_seconds{stage="db_write"}', "avg"),
+        "db_write_p95_seconds": _metric(summary, 'parser_stage_wall_seconds{stage="db_write"}', "p95"),
+        "db_write_batches": _metric(summary, 'parser_stage_wall_seconds{stage="db_write"}', "count"),
+        # Считается по performance-логу, поэтому только в режиме EXTRACTION_MODE=network
+        "bytes_per_venue": round(_metric(summary, "parser_network_bytes_total") / venues_ok) if venues_ok else None,
+        "captchas_seen": _metric(summary, "parser_captchas_seen_total"),
+        "captchas_solved": _metric(summary, "parser_captchas_solved_total"),
+        "parser_peak_rss_mb": round(sampler.parser_peak / 2 ** 20, 1),
+        "browser_peak_rss_mb": round(sampler.browser_peak / 2 ** 20, 1),
+        "browsers_started": len(sampler.browsers),
+        "stages": stages,
+        "log": os.path.relpath(log_path, PARSER_DIR),
+    }
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PARSER_DIR, text=True).strip()
+    except Exception:
+        return None
+
+def load_previous(results_path, scenario, number):
+    previous = None
+    if os.path.exists(results_path):
+        with open(results_path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["scenario"] == scenario and record["pass"] == number:
+                    previous = record
+    return previous
+
+COMPARED = [
+    ("venues_per_min", True), ("reviews_per_second", True), ("db_write_avg_seconds", False),
+    ("db_write_p95_seconds", False), ("bytes_per_venue", False), ("parser_peak_rss_mb", False), ("browser_peak_rss_mb", False),
+]
+
+def print_comparison(result, previous):
+    for key, higher_is_better in COMPARED:
+        current = result.get(key)
+        line = f"  {key}: {current}"
+        if previous and previous["result"].get(key) and current is not None:
+            before = previous["result"][key]
+            delta = (current - before) / before * 100
+            better = (delta > 0) == higher_is_better
+            line += f" (было {before}, {delta:+.1f}%{'' if abs(delta) < 1 else ' лучше' if better else ' хуже'})"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк парсера против локальной заглушки Яндекс.Карт")
+    parser.add_argument("--venues", type=int, default=100, help="Заведений в выдаче")
+    parser.add_argument("--reviews-max", type=int, default=60, help="Максимум отзывов у заведения")
+    parser.add_argument("--reviews-page-size", type=int, default=20, help="Отзывов в одном ответе fetchReviews")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seed-dir", help="Каталог с дампами pre_check_page_*.html и captcha_page_*.html")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Задержка каждого ответа заглушки")
+    parser.add_argument("--captcha-rate", type=float, default=0.05, help="Доля страниц, отдаваемых с капчей")
+    parser.add_argument("--passes", type=int, default=1, help="Повторные проходы проверяют дообход новых отзывов")
+    parser.add_argument("--new-reviews", type=int, default=3, help="Новых отзывов у заведения перед каждым повторным проходом")
+    parser.add_argument("--db", default="reviews_bench", help="Отдельная база для бенчмарка")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Переменные окружения парсера")
+    parser.add_argument("--label", default="default", help="Имя сценария в результатах")
+    parser.add_argument("--timeout", type=float, default=3600, help="Ограничение одного прохода, сек")
+    parser.add_argument("--results", default=os.path.join(BENCH_DIR, "results", "results.jsonl"))
+    args = parser.parse_args()
+
+    overrides = dict(item.split("=", 1) for item in args.env)
+    venues = generate_venues(args.venues, seed=args.seed, reviews_max=args.reviews_max, seed_dir=args.seed_dir)
+    state = StubState(
+        venues,
+        latency=args.latency_ms / 1000,
+        captcha_rate=args.captcha_rate,
+        reviews_page_size=args.reviews_page_size,
+        captcha_template=load_captcha_template(args.seed_dir) if args.seed_dir else None,
+        seed=args.seed,
+    )
+    stub = start_stub_server(state)
+    host, port = stub.server_address
+    base_url = f"http://{host}:{port}/maps/213/moscow/search/кафе"
+    log_print(f"Заглушка запущена: {base_url}, заведений {len(venues)}, отзывов {sum(len(v['reviews']) for v in venues)}.")
+
+    prepare_database(args.db)
+    env = dict(os.environ, **DEFAULT_ENV)
+    env.update(overrides)
+    env.update({"BASE_URL": base_url, "POSTGRES_DB": args.db, "COUNT_OF_UNITS": str(args.venues)})
+
+    scenario = {
+        "label": args.label,
+        "venues": args.venues,
+        "reviews_max": args.reviews_max,
+        "reviews_page_size": args.reviews_page_size,
+        "seed": args.seed,
+        "seeded": bool(args.seed_dir),
+        "latency_ms": args.latency_ms,
+        "captcha_rate": args.captcha_rate,
+        "new_reviews": args.new_reviews,
+        "env": {key: env[key] for key in sorted(set(DEFAULT_ENV) | set(overrides))},
+    }
+    try:
+        for number in range(1, args.passes + 1):
+            if number > 1:
+                add_new_reviews(venues, args.new_reviews, seed=args.seed + number)
+            log_print(f"Проход {number}/{args.passes}...")
+            captchas_before = state.stats["captchas_served"]
+            heavy_before = state.stats["heavy_bytes"]
+            result = run_pass(env, args.label, number, args.timeout)
+            establishments, reviews_in_db = count_rows(args.db)
+            # Парсер берёт не больше 200 отзывов с заведения
+            reviews_expected = sum(min(len(venue["reviews"]), 200) for venue in venues)
+            result.update({
+                "captchas_served": state.stats["captchas_served"] - captchas_before,
+                "heavy_bytes_served": state.stats["heavy_bytes"] - heavy_before,
+                "establishments_in_db": establishments,
+                "reviews_in_db": reviews_in_db,
+                "reviews_expected": reviews_expected,
+                "complete": establishments == len(venues) and reviews_in_db == reviews_expected,
+            })
+            previous = load_previous(args.results, scenario, number)
+            record = {
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "commit": _git_commit(),
+                "scenario": scenario,
+                "pass": number,
+                "result": result,
+            }
+            os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+            with open(args.results, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            print(f"Проход {number}: заведений {establishments}/{len(venues)}, отзывов {reviews_in_db}/{reviews_expected}, "
+                  f"капч выдано {result['captchas_served']}, решено {result['captchas_solved']}, код выхода {result['exit_code']}")
+            print_comparison(result, previous)
+    finally:
+        stub.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+import argparse
+import html
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+from fixtures import RU_MONTHS_GENITIVE, generate_venues, load_captcha_template
+
+# Локальная заглушка Яндекс.Карт: страница поиска с бесконечной прокруткой, страницы организаций,
+# API search/fetchReviews и капча CheckboxCaptcha. Разметка повторяет классы, на которые опирается main.py.
+
+SEARCH_PAGE_SIZE = 20
+
+# Тяжёлые ресурсы, которые парсеру не нужны: векторные тайлы карты и веб-шрифт
+MAP_TILES_PER_PAGE = 16
+TILE_BYTES = 24 * 1024
+FONT_BYTES = 120 * 1024
+
+PAGE_STYLE = """
+@font-face { font-family: 'YS Text'; src: url('/fonts/ys-text.woff2') format('woff2'); }
+body { margin: 0; font-family: 'YS Text', sans-serif; }
+.search-snippet-view { min-height: 90px; border-bottom: 1px solid #ddd; padding: 8px; list-style: none; }
+.business-review-view { min-height: 120px; border-bottom: 1px solid #eee; padding: 8px; }
+.rating-ranking-view__popup { display: none; }
+.rating-ranking-view._open .rating-ranking-view__popup { display: block; }
+#bench-sentinel { height: 1px; }
+"""
+
+# Загрузка тайлов карты, как у векторной карты Яндекса (core-renderer-tiles .../vmap2/tiles)
+MAP_JS = """
+for (let i = 0; i < %(tiles)d; i++) {
+    fetch('/vmap2/tiles?lang=ru_RU&x=' + (i %% 4) + '&y=' + Math.floor(i / 4) + '&z=12').catch(() => {});
+}
+""" % {"tiles": MAP_TILES_PER_PAGE}
+
+SEARCH_PAGE_JS = """
+const list = document.querySelector('.search-list-view__list');
+const sentinel = document.getElementById('bench-sentinel');
+let skip = list.children.length;
+let total = %(total)d;
+let loading = false;
+const escape = (value) => { const el = document.createElement('div'); el.textContent = value; return el.innerHTML; };
+async function loadMore() {
+    if (loading || skip >= total) return;
+    loading = true;
+    const params = new URLSearchParams(location.search);
+    params.set('skip', skip);
+    params.set('results', %(page_size)d);
+    const response = await fetch('/maps/api/search?' + params.toString());
+    const payload = await response.json();
+    for (const item of payload.data.items) {
+        const li = document.createElement('li');
+        li.className = 'search-snippet-view';
+        li.innerHTML = '<div class="search-business-snippet-view">' +
+            '<a class="search-snippet-view__link-overlay" href="/maps/org/' + item.seoname + '/' + item.id + '/"></a>' +
+            '<div class="search-business-snippet-view__title">' + escape(item.title) + '</div>' +
+            '<div class="search-business-snippet-view__address">' + escape(item.address) + '</div></div>';
+        list.appendChild(li);
+    }
+    skip += payload.data.items.length;
+    total = payload.data.totalResultCount;
+    loading = false;
+}
+new IntersectionObserver((entries) => { if (entries.some(e => e.isIntersecting)) loadMore(); }).observe(sentinel);
+"""
+
+ORG_PAGE_JS = """
+const orgId = %(org_id)s;
+const months = %(months)s;
+const container = document.querySelector('.business-reviews-card-view__reviews-container');
+const sentinel = document.getElementById('bench-sentinel');
+let page = 0;
+let totalPages = 1;
+let loading = false;
+let started = false;
+let ranking = 'by_relevance';
+const escape = (value) => { const el = document.createElement('div'); el.textContent = value; return el.innerHTML; };
+const formatDate = (iso) => {
+    const d = new Date(iso);
+    const text = d.getUTCDate() + ' ' + months[d.getUTCMonth()];
+    return d.getUTCFullYear() === new Date().getUTCFullYear() ? text : text + ' ' + d.getUTCFullYear();
+};
+async function loadReviews() {
+    if (loading || page >= totalPages) return;
+    loading = true;
+    const requested = ranking;
+    const response = await fetch('/maps/api/business/fetchReviews?businessId=' + orgId + '&page=' + (page + 1) + '&ranking=' + requested);
+    const payload = await response.json();
+    if (requested !== ranking) { loading = false; return; }
+    for (const review of payload.data.reviews) {
+        const stars = '<span class="business-rating-badge-view__star _full"></span>'.repeat(review.rating) +
+            '<span class="business-rating-badge-view__star _empty"></span>'.repeat(5 - review.rating);
+        const div = document.createElement('div');
+        div.className = 'business-review-view';
+        div.innerHTML = '<div class="business-review-view__body">' +
+            '<span class="business-review-view__author">' + escape(review.author.name) + '</span>' +
+            '<div class="business-rating-badge-view__stars">' + stars + '</div>' +
+            '<span class="business-review-view__date">' + formatDate(review.updatedTime) + '</span>' +
+            '<span class="business-review-view__body-text">' + escape(review.text) + '</span></div>';
+        container.appendChild(div);
+    }
+    page = payload.data.params.page;
+    totalPages = payload.data.params.totalPages;
+    loading = false;
+    const rect = sentinel.getBoundingClientRect();
+    if (rect.top < window.innerHeight) loadReviews();
+}
+function openReviews() {
+    if (started) return;
+    started = true;
+    document.querySelector('.business-reviews-card-view').style.display = 'block';
+    loadReviews();
+}
+document.querySelector('a._name_reviews').addEventListener('click', (event) => {
+    event.preventDefault();
+    history.pushState({}, '', event.currentTarget.getAttribute('href'));
+    openReviews();
+});
+document.querySelector('.rating-ranking-view').addEventListener('click', (event) => {
+    event.currentTarget.classList.toggle('_open');
+});
+for (const line of document.querySelectorAll('.rating-ranking-view__popup-line')) {
+    line.addEventListener('click', (event) => {
+        event.stopPropagation();
+        ranking = line.dataset.ranking;
+        container.innerHTML = '';
+        page = 0;
+        totalPages = 1;
+        loading = false;
+        loadReviews();
+    });
+}
+new IntersectionObserver((entries) => { if (started && entries.some(e => e.isIntersecting)) loadReviews(); }).observe(sentinel);
+fetch('/maps/api/search?oid=' + orgId);
+if (location.pathname.endsWith('/reviews/')) openReviews();
+"""
+
+CAPTCHA_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Ой!</title></head>
+<body>
+<form class="CheckboxCaptcha" action="/bench/captcha/pass" method="get">
+    <input type="hidden" name="next" value="%(next)s">
+    <div data-type="checkbox" class="CheckboxCaptcha-Anchor">
+        <input class="CheckboxCaptcha-Button" type="submit" value="Я не робот">
+    </div>
+</form>
+</body></html>
+"""
+
+# Подключается к сохранённому дампу капчи: кнопка ведёт на локальный обработчик вместо Яндекса
+CAPTCHA_DUMP_JS = """
+<script>
+document.addEventListener('click', (event) => {
+    if (!event.target.closest('.CheckboxCaptcha-Button')) return;
+    event.preventDefault();
+    location.href = '/bench/captcha/pass?next=' + encodeURIComponent(%(next)s);
+}, true);
+</script>
+"""
+
+class StubState:
+    def __init__(self, venues, latency=0.0, captcha_rate=0.0, reviews_page_size=20, captcha_template=None, seed=1):
+        self.venues = venues
+        self.by_id = {venue["id"]: venue for venue in venues}
+        self.latency = latency
+        self.captcha_rate = captcha_rate
+        self.reviews_page_size = reviews_page_size
+        self.captcha_template = captcha_template
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "captchas_served": 0, "captchas_passed": 0, "heavy_bytes": 0}
+        self._lock = threading.Lock()
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def captcha_roll(self):
+        with self._lock:
+            return self.rng.random() < self.captcha_rate
+
+    # Заведения в области ll/spn, если она задана (сбор по тайлам)
+    def search(self, query):
+        venues = self.venues
+        if "ll" in query and "spn" in query:
+            lon, lat = map(float, query["ll"][0].split(","))
+            lon_span, lat_span = map(float, query["spn"][0].split(","))
+            venues = [
+                venue for venue in venues
+                if abs(venue["lon"] - lon) <= lon_span / 2 and abs(venue["lat"] - lat) <= lat_span / 2
+            ]
+        return venues
+
+def _api_item(venue):
+    return {
+        "id": venue["id"],
+        "seoname": venue["slug"],
+        "title": venue["name"],
+        "address": venue["address"],
+        "fullAddress": venue["address"],
+        "phones": [{"number": venue["phone"]}],
+        "ratingData": {"ratingValue": venue["rating"], "ratingCount": venue["rate_count"]},
+        "urls": [venue["site"]],
+        "features": [{"id": "average_bill2", "value": venue["average_bill"]}],
+        "coordinates": [venue["lon"], venue["lat"]],
+    }
+
+def _api_review(review):
+    return {
+        "reviewId": review["id"],
+        "author": {"name": review["author"]},
+        "text": review["text"],
+        "rating": review["rating"],
+        "updatedTime": review["date"].isoformat() + "T12:00:00.000Z",
+    }
+
+def _snippet_html(venue):
+    return (
+        '<li class="search-snippet-view"><div class="search-business-snippet-view">'
+        f'<a class="search-snippet-view__link-overlay" href="/maps/org/{quote(venue["slug"])}/{venue["id"]}/"></a>'
+        f'<div class="search-business-snippet-view__title">{html.escape(venue["name"])}</div>'
+        f'<div class="search-business-snippet-view__address">{html.escape(venue["address"])}</div>'
+        "</div></li>"
+    )
+
+def render_search_page(venues):
+    snippets = "".join(_snippet_html(venue) for venue in venues[:SEARCH_PAGE_SIZE])
+    script = SEARCH_PAGE_JS % {"total": len(venues), "page_size": SEARCH_PAGE_SIZE}
+    return (
+        f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Поиск</title><style>{PAGE_STYLE}</style></head><body>"
+        f'<div class="search-list-view"><ul class="search-list-view__list">{snippets}</ul><div id="bench-sentinel"></div></div>'
+        f"<script>{MAP_JS}{script}</script></body></html>"
+    )
+
+def render_org_page(venue):
+    rate_spans = "".join(
+        f'<span class="business-summary-rating-badge-view__rating-text">{part}</span>'
+        for part in (str(int(venue["rating"])), ",", str(round(venue["rating"] * 10) % 10))
+    )
+    # Разряды разделены неразрывным пробелом, как на странице Яндекса
+    rate_count = f"{venue['rate_count']:,}".replace(",", "\u00a0")
+    base = f'/maps/org/{quote(venue["slug"])}/{venue["id"]}/'
+    script = ORG_PAGE_JS % {"org_id": json.dumps(venue["id"]), "months": json.dumps(RU_MONTHS_GENITIVE, ensure_ascii=False)}
+    return (
+        f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>{html.escape(venue['name'])}</title>"
+        f"<style>{PAGE_STYLE}</style></head><body>"
+        f'<h1 class="orgpage-header-view__header">{html.escape(venue["name"])}</h1>'
+        f'<div class="business-contacts-view__address-link">{html.escape(venue["address"])}</div>'
+        f'<div class="orgpage-phones-view__phone-number">{html.escape(venue["phone"])}</div>'
+        f'<div class="business-summary-rating-badge-view">{rate_spans}</div>'
+        f'<span class="business-header-rating-view__text">{rate_count} оценок</span>'
+        f'<span class="business-urls-view__text">{html.escape(venue["site"])}</span>'
+        f'<span class="business-features-view__valued-value">{html.escape(venue["average_bill"])}</span>'
+        f'<a class="tabs-select-view__title _name_reviews" href="{base}reviews/">Отзывы</a>'
+        '<div class="business-reviews-card-view" style="display: none">'
+        '<div class="rating-ranking-view">По умолчанию<div class="rating-ranking-view__popup">'
+        '<div class="rating-ranking-view__popup-line" data-ranking="by_relevance">По умолчанию</div>'
+        '<div class="rating-ranking-view__popup-line" data-ranking="by_time">По новизне</div>'
+        "</div></div>"
+        '<div class="business-reviews-card-view__reviews-container"></div></div>'
+        f'<div id="bench-sentinel"></div><script>{MAP_JS}{script}</script></body></html>'
+    )
+
+class StubHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def do_GET(self):
+        state = self.state
+        state.count("requests")
+        if state.latency:
+            time.sleep(state.latency)
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        path = parts.path
+        if path == "/maps/api/search":
+            self._search_api(query)
+        elif path == "/maps/api/business/fetchReviews":
+            self._reviews_api(query)
+        elif path == "/bench/captcha/pass":
+            state.count("captchas_passed")
+            self.send_response(302)
+            self.send_header("Location", query.get("next", ["/"])[0])
+            self.send_header("Set-Cookie", "bench_pass=1; Path=/")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif path == "/vmap2/tiles":
+            self._send_bytes(TILE_BYTES, "application/x-protobuf")
+        elif path.startswith("/fonts/"):
+            self._send_bytes(FONT_BYTES, "font/woff2")
+        elif path == "/bench/stats":
+            self._send(json.dumps(state.stats), "application/json")
+        elif "/org/" in path or "/search/" in path:
+            if "bench_pass=1" not in (self.headers.get("Cookie") or "") and state.captcha_roll():
+                state.count("captchas_served")
+                self._send(self._captcha_page(), "text/html")
+            elif "/org/" in path:
+                venue = self._venue_from_path(path)
+                if venue is None:
+                    self.send_error(404)
+                else:
+                    self._send(render_org_page(venue), "text/html")
+            else:
+                self._send(render_search_page(state.search(query)), "text/html")
+        else:
+            self.send_error(404)
+
+    def _venue_from_path(self, path):
+        segments = [segment for segment in path.split("/") if segment]
+        for segment in segments:
+            if segment.isdigit() and segment in self.state.by_id:
+                return self.state.by_id[segment]
+        return None
+
+    def _captcha_page(self):
+        if self.state.captcha_template:
+            return self.state.captcha_template.replace("</body>", CAPTCHA_DUMP_JS % {"next": json.dumps(self.path)} + "</body>")
+        return CAPTCHA_PAGE % {"next": html.escape(self.path, quote=True)}
+
+    def _search_api(self, query):
+        if "oid" in query:
+            venue = self.state.by_id.get(query["oid"][0])
+            items = [_api_item(venue)] if venue else []
+            self._send(json.dumps({"data": {"items": items, "totalResultCount": len(items)}}, ensure_ascii=False), "application/json")
+            return
+        venues = self.state.search(query)
+        skip = int(query.get("skip", ["0"])[0])
+        results = int(query.get("results", [str(SEARCH_PAGE_SIZE)])[0])
+        items = [_api_item(venue) for venue in venues[skip:skip + results]]
+        self._send(json.dumps({"data": {"items": items, "totalResultCount": len(venues)}}, ensure_ascii=False), "application/json")
+
+    def _reviews_api(self, query):
+        venue = self.state.by_id.get(query.get("businessId", [""])[0])
+        if venue is None:
+            self.send_error(404)
+            return
+        page = int(query.get("page", ["1"])[0])
+        size = self.state.reviews_page_size
+        reviews = venue["reviews"]
+        if query.get("ranking", ["by_relevance"])[0] != "by_time":
+            # «По умолчанию» — стабильный порядок, отличный от хронологического
+            reviews = sorted(reviews, key=lambda review: str(review["id"])[::-1])
+        total_pages = max(1, -(-len(reviews) // size))
+        payload = {"data": {
+            "reviews": [_api_review(review) for review in reviews[(page - 1) * size:page * size]],
+            "params": {"page": page, "pageSize": size, "totalPages": total_pages, "count": len(reviews)},
+        }}
+        self._send(json.dumps(payload, ensure_ascii=False), "application/json")
+
+    def _send(self, body, content_type):
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Двоичный ответ заданного размера; содержимое не важно, важен объём
+    def _send_bytes(self, size, content_type):
+        self.state.count("heavy_bytes", size)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(bytes(size))
+
+    def log_message(self, format, *args):
+        pass
+
+# Запуск заглушки в фоновом потоке; возвращает сервер, адрес — server.server_address
+def start_stub_server(state, host="127.0.0.1", port=0):
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-http", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная заглушка Яндекс.Карт для бенчмарка парсера")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--venues", type=int, default=200)
+    parser.add_argument("--reviews-max", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seed-dir", help="Каталог с дампами pre_check_page_*.html и captcha_page_*.html")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--captcha-rate", type=float, default=0.05)
+    args = parser.parse_args()
+    stub_state = StubState(
+        generate_venues(args.venues, seed=args.seed, reviews_max=args.reviews_max, seed_dir=args.seed_dir),
+        latency=args.latency_ms / 1000,
+        captcha_rate=args.captcha_rate,
+        captcha_template=load_captcha_template(args.seed_dir) if args.seed_dir else None,
+        seed=args.seed,
+    )
+    stub = start_stub_server(stub_state, host="0.0.0.0", port=args.port)
+    print(f"Заглушка запущена: http://127.0.0.1:{args.port}/maps/213/moscow/search/кафе")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.shutdown()
@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import re
+import resource
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal
+from urllib.parse import quote
+
+import psycopg2
+
+from main import (
+    close_db_pool, db_connection, db_params, get_job_watermark, get_job_watermark_at,
+    log_print, set_job_watermark, setup_database,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Потоковая выгрузка заведений и отзывов в Parquet или JSONL. Строки читаются серверными курсорами
+# и пишутся пачками по EXPORT_BATCH_ROWS, поэтому память не зависит от размера таблиц.
+# Раскладка каталогов в стиле Hive: <dataset>/title=<тип>/city=<город>/crawl_date=<дата обхода>/part-*.parquet
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")  # Корневой каталог выгрузки
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "parquet").lower()  # parquet или jsonl
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "50000"))  # Строк в группе строк Parquet и в пачке чтения
+EXPORT_SETTLE_TIMEOUT = float(os.getenv("EXPORT_SETTLE_TIMEOUT", "120"))  # Сколько ждать завершения пишущих транзакций, сек
+
+# Колонки файлов; title, city и crawl_date задаются каталогами партиций
+ESTABLISHMENT_FIELDS = (
+    ("id", "int64"), ("href", "string"), ("name", "string"), ("address", "string"), ("phone", "string"),
+    ("rate", "float64"), ("rate_count", "int32"), ("site", "string"), ("average_bill", "string"),
+    ("crawled_at", "timestamp"),
+)
+REVIEW_FIELDS = (
+    ("id", "int64"), ("establishment_id", "int64"), ("author", "string"), ("rating", "int16"),
+    ("review_text", "string"), ("date", "date32"), ("content_hash", "string"),
+)
+
+# Ключи партиции считаются в SQL, и строки идут в порядке партиций: у писателя открыт один файл за раз,
+# а группы строк получаются полными, даже когда отзывы одной партиции разбросаны по id.
+# Дата обхода и отметка берутся из crawled_at: finished_at сдвигает и неудачная попытка, а новых данных она не даёт
+PARTITION_COLUMNS = """
+    coalesce(NULLIF(cs.title, ''), 'unknown') AS part_title,
+    coalesce(substring(cs.source_url from '/maps/[0-9]+/([^/?#]+)'), 'unknown') AS part_city,
+    coalesce(cs.crawled_at::date::text, 'unknown') AS part_crawl_date
+"""
+ESTABLISHMENTS_SQL = f"""
+    SELECT e.id, e.href, e.name, e.address, e.phone, e.rate::float8, e.rate_count, e.site, e.average_bill,
+           cs.crawled_at, {PARTITION_COLUMNS}
+    FROM establishment_data e
+    LEFT JOIN crawl_state cs ON cs.href = e.href
+    WHERE (cs.crawled_at > COALESCE(%(since)s::timestamptz, '-infinity') AND cs.crawled_at <= %(until)s)
+       OR (%(full)s AND cs.crawled_at IS NULL)
+    ORDER BY part_title, part_city, part_crawl_date, e.id
+"""
+REVIEWS_SQL = f"""
+    SELECT r.id, r.establishment_id, r.author, r.rating, r.review_text, r.date, r.content_hash, {PARTITION_COLUMNS}
+    FROM reviews r
+    LEFT JOIN establishment_data e ON e.id = r.establishment_id
+    LEFT JOIN crawl_state cs ON cs.href = e.href
+    WHERE r.id > %(since)s AND r.id <= %(until)s
+    ORDER BY part_title, part_city, part_crawl_date, r.id
+"""
+
+# Значение партиции в имени каталога: экранируем только символы, ломающие путь или разбор key=value
+def partition_value(value):
+    return re.sub(r"[/\\=%]", lambda match: quote(match.group(), safe=""), str(value)) or "unknown"
+
+def partition_of(title, city, crawl_date):
+    return (("title", title), ("city", city), ("crawl_date", crawl_date))
+
+def _arrow_schema(fields):
+    types = {
+        "int16": pa.int16(), "int32": pa.int32(), "int64": pa.int64(), "float64": pa.float64(),
+        "string": pa.string(), "date32": pa.date32(), "timestamp": pa.timestamp("us", tz="UTC"),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in fields])
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+# Запись строк, упорядоченных по партициям: открыт один файл текущей партиции, группа строк — при заполнении буфера.
+# Файлы пишутся под временным именем и переименовываются в close(), так что читатели не видят недописанных частей
+class PartitionedWriter:
+    def __init__(self, root, dataset, fmt, fields, batch_rows, run_id):
+        self.root = os.path.join(root, dataset)
+        self.fmt = fmt
+        self.fields = fields
+        self.names = [name for name, _ in fields]
+        self.batch_rows = batch_rows
+        self.run_id = run_id
+        self.schema = _arrow_schema(fields) if fmt == "parquet" else None
+        self.rows_written = 0
+        self._partition = None
+        self._buffer = []
+        self._file = None  # (handle, temp_path, final_path) текущей партиции
+        self._finished = []  # Закрытые файлы, ожидающие переименования
+        self._parts = {}  # Каталог -> число файлов этого запуска, если партиция встретилась повторно
+
+    def write(self, partition, row):
+        if partition != self._partition:
+            self._flush()
+            self._close_file()
+            self._partition = partition
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_rows:
+            self._flush()
+
+    def _open(self):
+        directory = os.path.join(self.root, *(f"{key}={partition_value(value)}" for key, value in self._partition))
+        os.makedirs(directory, exist_ok=True)
+        seq = self._parts.get(directory, 0)
+        self._parts[directory] = seq + 1
+        name = f"part-{self.run_id}" + (f"-{seq}" if seq else "")
+        final_path = os.path.join(directory, f"{name}.{self.fmt}")
+        temp_path = os.path.join(directory, f".{name}.{self.fmt}.tmp")
+        if self.fmt == "parquet":
+            handle = pq.ParquetWriter(temp_path, self.schema, compression="zstd")
+        else:
+            handle = open(temp_path, "w", encoding="utf-8")
+        self._file = (handle, temp_path, final_path)
+        return handle
+
+    def _flush(self):
+        rows, self._buffer = self._buffer, []
+        if not rows:
+            return
+        handle = self._file[0] if self._file else self._open()
+        if self.fmt == "parquet":
+            columns = list(zip(*rows))
+            handle.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                schema=self.schema,
+            ), row_group_size=self.batch_rows)
+        else:
+            extra = dict(self._partition)
+            for row in rows:
+                record = dict(zip(self.names, row))
+                record.update(extra)
+                handle.write(json.dumps(record, ensure_ascii=False, default=_json_value) + "\n")
+        self.rows_written += len(rows)
+
+    def _close_file(self):
+        if self._file:
+            handle, temp_path, final_path = self._file
+            self._file = None
+            handle.close()
+            self._finished.append((temp_path, final_path))
+
+    def close(self):
+        self._flush()
+        self._close_file()
+        for temp_path, final_path in self._finished:
+            os.replace(temp_path, final_path)
+        return len(self._finished)
+
+    # Прерванная выгрузка: временные файлы удаляются, отметки не сдвигаются
+    def abort(self):
+        self._buffer = []
+        try:
+            if self._file:
+                self._file[0].close()
+                self._finished.append(self._file[1:])
+        finally:
+            self._file = None
+            for temp_path, _ in self._finished:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            self._finished.clear()
+
+# Граница выгрузки, до которой все пишущие транзакции завершены. id отзывов выдаются до коммита,
+# поэтому сначала фиксируем последнее выданное значение последовательности и время, затем ждём транзакции,
+# которые в этот момент могли держать незакоммиченные строки. Всё не выше границы уже видно или откатилось.
+def settle_writes(conn, timeout):
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute("SELECT now(), pg_sequence_last_value(pg_get_serial_sequence('reviews', 'id'))")
+    until_at, until_id = cursor.fetchone()
+    writers_sql = """
+        SELECT pid, xact_start FROM pg_stat_activity
+        WHERE pid <> pg_backend_pid() AND datname = current_database() AND xact_start IS NOT NULL
+          AND xact_start <= %s AND (backend_xid IS NOT NULL OR state = 'active')
+    """
+    cursor.execute(writers_sql, (until_at,))
+    pending = set(cursor.fetchall())
+    deadline = time.monotonic() + timeout
+    while pending:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"не дождались завершения {len(pending)} пишущих транзакций за {timeout:.0f} с")
+        time.sleep(0.2)
+        cursor.execute(writers_sql, (until_at,))
+        pending &= set(cursor.fetchall())
+    conn.autocommit = False
+    return until_id or 0, until_at
+
+def _stream(conn, name, sql, params, batch_rows):
+    cursor = conn.cursor(name=name)
+    cursor.itersize = batch_rows
+    cursor.execute(sql, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cursor.close()
+
+# Функция выгрузки: заведения, обойдённые после прошлой выгрузки, и отзывы с id выше прошлой отметки
+def run_export(out_dir, fmt, batch_rows, full=False):
+    if fmt not in ("parquet", "jsonl"):
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    if fmt == "parquet" and pa is None:
+        raise RuntimeError("Для выгрузки в Parquet нужен pyarrow (pip install pyarrow) или формат jsonl")
+    setup_database()
+    establishments_job = f"export_{fmt}_establishments"
+    reviews_job = f"export_{fmt}_reviews"
+
+    reader = psycopg2.connect(**db_params)
+    run_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    writers = {
+        "establishments": PartitionedWriter(out_dir, "establishments", fmt, ESTABLISHMENT_FIELDS, batch_rows, run_id),
+        "reviews": PartitionedWriter(out_dir, "reviews", fmt, REVIEW_FIELDS, batch_rows, run_id),
+    }
+    started = time.perf_counter()
+    try:
+        cursor = reader.cursor()
+        since_id = 0 if full else get_job_watermark(cursor, reviews_job)
+        since_at = None if full else get_job_watermark_at(cursor, establishments_job)
+        reader.commit()
+        until_id, until_at = settle_writes(reader, EXPORT_SETTLE_TIMEOUT)
+        log_print(f"Выгрузка {fmt} ({run_id}): отзывы с id {since_id}..{until_id}, заведения, обойдённые после {since_at or 'начала'}.")
+
+        # Оба курсора в одном снимке, чтобы заведения и отзывы были согласованы
+        reader.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        for row in _stream(reader, "export_establishments", ESTABLISHMENTS_SQL, {
+            "since": since_at, "until": until_at, "full": full,
+        }, batch_rows):
+            writers["establishments"].write(partition_of(*row[10:13]), row[:10])
+        for row in _stream(reader, "export_reviews", REVIEWS_SQL, {"since": since_id, "until": until_id}, batch_rows):
+            writers["reviews"].write(partition_of(*row[7:10]), row[:7])
+        reader.commit()
+
+        files = sum(writer.close() for writer in writers.values())
+    except Exception:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    finally:
+        reader.close()
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        set_job_watermark(cursor, reviews_job, until_id)
+        set_job_watermark(cursor, establishments_job, 0, until_at)
+    close_db_pool()
+
+    elapsed = time.perf_counter() - started
+    rows = sum(writer.rows_written for writer in writers.values())
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    log_print(
+        f"Выгрузка завершена: заведений {writers['establishments'].rows_written}, отзывов {writers['reviews'].rows_written}, "
+        f"файлов {files}, {rows / elapsed if elapsed > 0 else 0:.0f} строк/с, пиковая память {peak_rss_mb:.0f} МБ."
+    )
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Потоковая выгрузка заведений и отзывов в Parquet или JSONL")
+    parser.add_argument("--out", default=EXPORT_DIR, help="Каталог выгрузки")
+    parser.add_argument("--format", choices=("parquet", "jsonl"), default=EXPORT_FORMAT)
+    parser.add_argument("--batch-rows", type=int, default=EXPORT_BATCH_ROWS, help="Строк в группе строк и пачке чтения")
+    parser.add_argument("--full", action="store_true", help="Выгрузить всё, не глядя на прошлую отметку")
+    args = parser.parse_args()
+    run_export(args.out, args.format, args.batch_rows, args.full)
+
+if __name__ == "__main__":
+    main()
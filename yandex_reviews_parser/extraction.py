@@ -0,0 +1,93 @@
+import os
+
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# Движки разбора полей заведения из HTML-фрагмента страницы организации. Оба возвращают одинаковый словарь
+# {"href", "name", "address", "phone", "rate", "rate_count", "site", "average_bill"} со значением "null"
+# для отсутствующих полей. Отзывы сюда не входят: main.py читает их JS-скриптом в браузере или из ответов API.
+
+# (тег, класс) -> поле заведения; для rate склеиваются все совпадения, для остальных берётся первое
+ORG_FIELD_CLASSES = {
+    ("h1", "orgpage-header-view__header"): "name",
+    ("div", "business-contacts-view__address-link"): "address",
+    ("div", "orgpage-phones-view__phone-number"): "phone",
+    ("span", "business-summary-rating-badge-view__rating-text"): "rate",
+    ("span", "business-header-rating-view__text"): "rate_count",
+    ("span", "business-urls-view__text"): "site",
+    ("span", "business-features-view__valued-value"): "average_bill",
+}
+ORG_TEXT_FIELDS = ("name", "address", "phone", "rate_count", "site", "average_bill")
+
+# Приведение полей к тому виду, что сохраняет парсер: рейтинг с точкой, пустые поля — "null"
+def _org_result(url, texts, rate_parts):
+    data = {"href": url}
+    for field in ORG_TEXT_FIELDS:
+        value = texts.get(field)
+        data[field] = value if value else "null"
+    # Рейтинг разбит на спаны «4», «,», «7»: склеиваем вместе с запятой
+    data["rate"] = "".join(rate_parts).replace(",", ".") if rate_parts else "null"
+    # Порядок ключей как в прежнем разборе
+    return {key: data[key] for key in ("href", "name", "address", "phone", "rate", "rate_count", "site", "average_bill")}
+
+# --- lxml: один проход по дереву, классы сравниваются по токенам атрибута class ---
+
+_HTML_PARSER = etree.HTMLParser(recover=True, remove_comments=True) if etree is not None else None
+
+def _lxml_root(html):
+    if not html or not html.strip():
+        return None
+    return etree.fromstring(html, _HTML_PARSER)
+
+def _text(element):
+    return "".join(element.itertext()).strip()
+
+def _lxml_org_fields(url, html):
+    texts = {}
+    rate_parts = []
+    root = _lxml_root(html)
+    if root is not None:
+        for element in root.iter(tag=("h1", "div", "span")):
+            classes = element.get("class")
+            if not classes:
+                continue
+            for token in classes.split():
+                field = ORG_FIELD_CLASSES.get((element.tag, token))
+                if field == "rate":
+                    rate_parts.append(_text(element))
+                elif field and field not in texts:
+                    texts[field] = _text(element)
+    return _org_result(url, texts, rate_parts)
+
+# --- BeautifulSoup: прежний разбор, запасной вариант и эталон для сверки ---
+
+def _bs4_org_fields(url, html):
+    soup = BeautifulSoup(html, "html.parser")
+    texts = {}
+    rate_parts = []
+    for (tag, class_name), field in ORG_FIELD_CLASSES.items():
+        if field == "rate":
+            rate_parts = [elem.text.strip() for elem in soup.find_all(tag, class_=class_name)]
+        else:
+            element = soup.find(tag, class_=class_name)
+            texts[field] = element.text.strip() if element else None
+    return _org_result(url, texts, rate_parts)
+
+ENGINES = {
+    "lxml": _lxml_org_fields,
+    "bs4": _bs4_org_fields,
+}
+
+# Движок из EXTRACTION_ENGINE; без установленного lxml используется BeautifulSoup
+EXTRACTION_ENGINE = os.getenv("EXTRACTION_ENGINE", "lxml").lower()
+if EXTRACTION_ENGINE not in ENGINES or (EXTRACTION_ENGINE == "lxml" and etree is None):
+    EXTRACTION_ENGINE = "bs4"
+
+# Функция разбора полей заведения из HTML-фрагмента
+def parse_establishment_fields(url, html, engine=None):
+    return ENGINES[engine or EXTRACTION_ENGINE](url, html)
+
@@ -1,17 +1,36 @@
+import base64
+import hashlib
+import json
+import fnmatch
+import math
+import multiprocessing
 import os
+import queue
 import random
+import re
+import socket
+import threading
 import time
 import traceback
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
-from bs4 import BeautifulSoup
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import TimeoutException
+import extraction
+import metrics
 import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import execute_values
 
 # Список User-Agent'ов
 USER_AGENTS = [
@@ -23,11 +42,11 @@ USER_AGENTS = [
 
 # Параметры подключения к PostgreSQL
 db_params = {
-    "host": "db",
-    "port": 5432,  # Внутренний порт в сети Docker
-    "user": "postgres",
-    "password": "qwerty12345",
-    "database": "reviews_db",
+    "host": os.getenv("POSTGRES_HOST", "db"),
+    "port": int(os.getenv("POSTGRES_PORT", "5432")),  # Внутренний порт в сети Docker
+    "user": os.getenv("POSTGRES_USER", "postgres"),
+    "password": os.getenv("POSTGRES_PASSWORD", "qwerty12345"),
+    "database": os.getenv("POSTGRES_DB", "reviews_db"),
     "client_encoding": "UTF8"
 }
 
@@ -35,104 +54,1275 @@ db_params = {
 def log_print(message):
     print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
 
+SETUP_LOCK_KEY = 7_161_006  # pg_advisory_lock: схему и миграции настраивает один процесс, остальные реплики ждут
+# Версия схемы в job_watermarks: при совпадении настройка не выполняет ни одного DDL.
+# Увеличивается при каждом изменении DDL или миграций в setup_database
+SCHEMA_VERSION = 1
+SETUP_LOCK_TIMEOUT = os.getenv("SETUP_LOCK_TIMEOUT", "10s")  # Сколько DDL ждёт блокировку таблицы до повтора
+SETUP_ATTEMPTS = int(os.getenv("SETUP_ATTEMPTS", "30"))  # Попыток настройки, если таблицы заняты долгими транзакциями
+
 # Функция для настройки базы данных
 def setup_database():
     log_print("Проверка подключения и настройка базы данных...")
     try:
         conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS establishment_data (
-                id SERIAL PRIMARY KEY,
-                href TEXT,
-                name TEXT,
-                address TEXT,
-                phone TEXT,
-                rate TEXT,
-                rate_count TEXT,
-                site TEXT,
-                average_bill TEXT
-            );
-            
-            CREATE TABLE IF NOT EXISTS reviews (
-                id SERIAL PRIMARY KEY,
-                establishment_id INTEGER REFERENCES establishment_data(id),
-                author TEXT,
-                rating TEXT,
-                review_text TEXT,
-                date TEXT
-            );
-        """)
-        conn.commit()
-        cursor.execute("SELECT 1")
-        conn.close()
+        try:
+            cursor = conn.cursor()
+            # Блокировка сеансовая: переживает промежуточные коммиты миграций и снимается при закрытии соединения.
+            # Ждём опросом вне транзакции: запрос, повисший в pg_advisory_lock, держал бы снимок,
+            # и CREATE INDEX CONCURRENTLY у владельца блокировки ждал бы его до бесконечности
+            conn.autocommit = True
+            while True:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (SETUP_LOCK_KEY,))
+                if cursor.fetchone()[0]:
+                    break
+                log_print("Базу настраивает другой процесс, ожидание...")
+                time.sleep(5)
+            conn.autocommit = False
+            # ALTER TABLE берёт ACCESS EXCLUSIVE и, ожидая долгую выгрузку, задержал бы за собой все запросы к таблице,
+            # поэтому DDL ждёт не дольше SETUP_LOCK_TIMEOUT, а настройка повторяется позже
+            for attempt in range(1, SETUP_ATTEMPTS + 1):
+                try:
+                    _setup_schema(conn)
+                    break
+                except psycopg2.errors.LockNotAvailable:
+                    conn.rollback()
+                    conn.autocommit = False
+                    if attempt == SETUP_ATTEMPTS:
+                        raise
+                    log_print(f"Таблицы заняты долгой транзакцией, повтор настройки базы ({attempt}/{SETUP_ATTEMPTS})...")
+                    time.sleep(random.uniform(5, 15))
+        finally:
+            conn.close()
         log_print("База данных настроена или уже существует.")
     except Exception as e:
         log_print(f"Ошибка подключения: {e}")
         raise
 
-# Функция для сохранения данных о заведении
-def save_establishment_to_db(data):
-    log_print(f"Сохранение данных о заведении: {data}")
-    try:
-        conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO establishment_data (href, name, address, phone, rate, rate_count, site, average_bill)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            data.get("href", "null"),
-            data.get("name", "null"),
-            data.get("address", "null"),
-            data.get("phone", "null"),
-            data.get("rate", "null"),
-            data.get("rate_count", "null"),
-            data.get("site", "null"),
-            data.get("average_bill", "null")
-        ))
-        establishment_id = cursor.fetchone()[0]
+def _setup_schema(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT to_regclass('job_watermarks') IS NOT NULL")
+    if cursor.fetchone()[0] and get_job_watermark(cursor, "schema_version") >= SCHEMA_VERSION:
         conn.commit()
-        log_print(f"Данные о заведении сохранены. ID: {establishment_id}")
-        return establishment_id
-    except Exception as e:
-        log_print(f"Ошибка сохранения заведения: {e}")
+        return
+    log_print(f"Обновление схемы базы до версии {SCHEMA_VERSION}...")
+    cursor.execute("SET lock_timeout = %s", (SETUP_LOCK_TIMEOUT,))
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS establishment_data (
+            id SERIAL PRIMARY KEY,
+            href TEXT,
+            name TEXT,
+            address TEXT,
+            phone TEXT,
+            rate NUMERIC(2, 1),
+            rate_count INTEGER,
+            site TEXT,
+            average_bill TEXT
+        );
+        
+        CREATE TABLE IF NOT EXISTS reviews (
+            id SERIAL PRIMARY KEY,
+            establishment_id INTEGER REFERENCES establishment_data(id),
+            author TEXT,
+            rating SMALLINT,
+            review_text TEXT,
+            date DATE
+        );
+
+        -- Состояние обхода по каждому заведению: позволяет продолжить прерванный запуск
+        CREATE TABLE IF NOT EXISTS crawl_state (
+            href TEXT PRIMARY KEY,
+            source_url TEXT,
+            title TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            establishment_id INTEGER REFERENCES establishment_data(id),
+            started_at TIMESTAMPTZ,
+            finished_at TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS crawl_state_source_status_idx ON crawl_state (source_url, status);
+
+        -- crawl_state служит и очередью заданий: аренда, повторы с задержкой и статус dead
+        ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS lease_owner TEXT;
+        ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+        ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS available_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        CREATE INDEX IF NOT EXISTS crawl_state_queue_idx ON crawl_state (status, available_at);
+        UPDATE crawl_state SET status = 'pending' WHERE status = 'failed';
+
+        -- Приоритет задания и признаки для его расчёта: время последнего успешного обхода,
+        -- прирост отзывов в день и изменчивость рейтинга между обходами
+        ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS priority DOUBLE PRECISION NOT NULL DEFAULT 0;
+        ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS crawled_at TIMESTAMPTZ;
+        ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS last_rate NUMERIC(2, 1);
+        ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS last_rate_count INTEGER;
+        ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS review_velocity DOUBLE PRECISION;
+        ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS rate_volatility DOUBLE PRECISION;
+        CREATE INDEX IF NOT EXISTS crawl_state_priority_idx ON crawl_state (status, priority DESC);
+
+        -- Бюджеты запросов (token bucket), общие для всех процессов
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            name TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+        );
+
+        ALTER TABLE reviews ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+        -- Отметки фоновых заданий: до какого id строки уже обработаны
+        CREATE TABLE IF NOT EXISTS job_watermarks (
+            job TEXT PRIMARY KEY,
+            last_id BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        -- Отметка по времени для заданий, читающих обновляемые строки (выгрузка заведений)
+        ALTER TABLE job_watermarks ADD COLUMN IF NOT EXISTS last_at TIMESTAMPTZ;
+
+        -- Тональность отзывов (sentiment.py) и накопительные суммы по заведениям
+        CREATE TABLE IF NOT EXISTS review_sentiment (
+            review_id INTEGER PRIMARY KEY REFERENCES reviews(id) ON DELETE CASCADE,
+            score REAL NOT NULL,
+            label TEXT NOT NULL,
+            model_version TEXT NOT NULL,
+            scored_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS establishment_sentiment (
+            establishment_id INTEGER PRIMARY KEY REFERENCES establishment_data(id) ON DELETE CASCADE,
+            scored_count INTEGER NOT NULL DEFAULT 0,
+            score_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            positive_count INTEGER NOT NULL DEFAULT 0,
+            negative_count INTEGER NOT NULL DEFAULT 0,
+            neutral_count INTEGER NOT NULL DEFAULT 0,
+            avg_score DOUBLE PRECISION GENERATED ALWAYS AS (score_sum / NULLIF(scored_count, 0)) STORED,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    conn.commit()
+    migrate_unique_keys(cursor)
+    conn.commit()
+    migrate_review_hashes(conn)
+    migrate_typed_columns(conn)
+    migrate_review_search_and_stats(conn)
+    # Обходы до появления планировщика: время и рейтинг последнего успешного обхода берём из текущих данных
+    cursor.execute("""
+        UPDATE crawl_state cs SET crawled_at = cs.finished_at, last_rate = e.rate, last_rate_count = e.rate_count
+        FROM establishment_data e
+        WHERE e.href = cs.href AND cs.status = 'done' AND cs.crawled_at IS NULL
+    """)
+    conn.commit()
+    # CREATE INDEX CONCURRENTLY не выполняется внутри транзакции и не мешает записи, пока ждёт старые транзакции,
+    # поэтому таймаут ему не нужен: прерванное построение оставило бы невалидный индекс, который IF NOT EXISTS не пересоздаст
+    conn.autocommit = True
+    cursor.execute("SET lock_timeout = 0")
+    cursor.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS reviews_establishment_date_idx ON reviews (establishment_id, date)")
+    cursor.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS reviews_search_idx ON reviews USING GIN (search_vector)")
+    conn.autocommit = False
+    set_job_watermark(cursor, "schema_version", SCHEMA_VERSION)
+    conn.commit()
+
+# Пробелы, которые по-разному приходят из API и из textContent разметки; класс понятен и re, и регуляркам PostgreSQL
+HASH_WHITESPACE = "[ \\t\\n\\r\\f\\v\\u00a0\\u2009\\u202f]+"
+HASH_WHITESPACE_RE = re.compile(HASH_WHITESPACE)
+
+def _hash_part(value):
+    normalized = HASH_WHITESPACE_RE.sub(" ", str(value)).strip(" ") if value is not None else ""
+    return normalized or "N/A"
+
+# Хэш содержимого отзыва; дата не участвует, так как Яндекс показывает относительные даты.
+# Пробелы схлопываются, чтобы один отзыв из API и из разметки давал один хэш
+def review_content_hash(review):
+    content = f"{_hash_part(review.get('author'))}\n{_hash_part(review.get('text'))}"
+    return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+# То же выражение в SQL для колонок author и review_text
+def _hash_part_sql(column):
+    return f"coalesce(NULLIF(btrim(regexp_replace({column}, '{HASH_WHITESPACE}', ' ', 'g'), ' '), ''), 'N/A')"
+
+REVIEW_HASH_SQL = f"md5({_hash_part_sql('author')} || E'\\n' || {_hash_part_sql('review_text')})"
+
+# Пустые значения старых версий парсера
+MISSING_VALUES = {"", "null", "N/A"}
+
+def clean_text(value):
+    if value is None:
         return None
-    finally:
-        if 'conn' in locals():
-            conn.close()
+    value = str(value).strip()
+    return None if value in MISSING_VALUES else value
 
-# Функция для сохранения отзывов
-def save_reviews_to_db(establishment_id, reviews_list):
-    if not establishment_id:
-        log_print("Пропуск сохранения отзывов: заведение не сохранено.")
-        return
-    log_print(f"Сохранение отзывов для заведения ID {establishment_id}")
+# Рейтинг заведения: "4,7" / "4.7" -> Decimal("4.7"). Старые версии склеивали "4" и "7" в "47".
+def parse_rate(value):
+    value = clean_text(value)
+    if value is None:
+        return None
+    match = re.search(r"\d+(?:[.,]\d+)?", value)
+    if not match:
+        return None
     try:
-        conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
-        for review in reviews_list:
+        rate = Decimal(match.group(0).replace(",", "."))
+    except InvalidOperation:
+        return None
+    if rate > 5 and "," not in match.group(0) and "." not in match.group(0) and rate < 100:
+        rate = rate / 10
+    return rate.quantize(Decimal("0.1")) if 0 <= rate <= 5 else None
+
+# Количество оценок: "1 234 оценки" -> 1234
+def parse_count(value):
+    value = clean_text(value)
+    if value is None:
+        return None
+    match = re.search(r"\d[\d\s\u00a0\u202f]*", value)
+    return int(re.sub(r"\D", "", match.group(0))) if match else None
+
+# Оценка отзыва в звёздах, 1–5
+def parse_review_rating(value):
+    value = clean_text(value)
+    if value is None:
+        return None
+    try:
+        rating = int(float(value))
+    except ValueError:
+        return None
+    return rating if 1 <= rating <= 5 else None
+
+RU_MONTHS = {
+    "января": 1, "февраля": 2, "марта": 3, "апреля": 4, "мая": 5, "июня": 6,
+    "июля": 7, "августа": 8, "сентября": 9, "октября": 10, "ноября": 11, "декабря": 12,
+}
+RELATIVE_UNITS = {
+    "минут": timedelta(0), "час": timedelta(0), "день": timedelta(days=1), "дня": timedelta(days=1),
+    "дней": timedelta(days=1), "недел": timedelta(weeks=1), "месяц": timedelta(days=30), "год": timedelta(days=365),
+    "лет": timedelta(days=365), "полгода": timedelta(days=182),
+}
+ABSOLUTE_DATE_RE = re.compile(r"(\d{1,2})\s+([а-яё]+)(?:\s+(\d{4}))?")
+RELATIVE_DATE_RE = re.compile(r"(?:(\d+)\s+)?([а-яё]+)\s+назад")
+
+# Дата отзыва из ISO-строки API или русской записи Яндекса: «сегодня», «3 дня назад», «12 марта», «12 марта 2023»
+def parse_review_date(value, reference=None):
+    value = clean_text(value)
+    if value is None:
+        return None
+    reference = reference or date.today()
+    text = value.lower().replace("\u00a0", " ")
+    iso = re.match(r"(\d{4})-(\d{2})-(\d{2})", text)
+    dotted = re.match(r"(\d{1,2})\.(\d{1,2})\.(\d{4})", text)
+    if iso or dotted:
+        if iso:
+            year, month, day = map(int, iso.groups())
+        else:
+            day, month, year = map(int, dotted.groups())
+        # Несуществующая дата («31.02.2024») не должна ронять миграцию или пачку записи
+        try:
+            return date(year, month, day)
+        except ValueError:
+            return None
+    if text.startswith("сегодня"):
+        return reference
+    if text.startswith("вчера"):
+        return reference - timedelta(days=1)
+    if text.startswith("позавчера"):
+        return reference - timedelta(days=2)
+    relative = RELATIVE_DATE_RE.search(text)
+    if relative:
+        amount = int(relative.group(1) or 1)
+        for prefix, unit in RELATIVE_UNITS.items():
+            if relative.group(2).startswith(prefix):
+                return reference - unit * amount
+    absolute = ABSOLUTE_DATE_RE.search(text)
+    if absolute and absolute.group(2) in RU_MONTHS:
+        day, month = int(absolute.group(1)), RU_MONTHS[absolute.group(2)]
+        if absolute.group(3):
+            try:
+                return date(int(absolute.group(3)), month, day)
+            except ValueError:
+                return None
+        # Без года Яндекс показывает даты за последние 12 месяцев: берём последнюю такую дату не позже reference.
+        # «29 февраля» в невисокосном году относится к ближайшему прошедшему високосному (между ними до 8 лет)
+        for year in range(reference.year, reference.year - 9, -1):
+            try:
+                parsed = date(year, month, day)
+            except ValueError:
+                continue
+            if parsed <= reference:
+                return parsed
+    return None
+
+# Строка establishment_data с типизированными значениями
+def establishment_row(data):
+    return (
+        data.get("href"),
+        clean_text(data.get("name")),
+        clean_text(data.get("address")),
+        clean_text(data.get("phone")),
+        parse_rate(data.get("rate")),
+        parse_count(data.get("rate_count")),
+        clean_text(data.get("site")),
+        clean_text(data.get("average_bill")),
+    )
+
+# Строка reviews с типизированными значениями; хэш считается по исходным строкам
+def review_row(establishment_id, review, reference=None):
+    return (
+        establishment_id,
+        clean_text(review.get("author")),
+        parse_review_rating(review.get("rating")),
+        clean_text(review.get("text")),
+        parse_review_date(review.get("date"), reference),
+        review_content_hash(review),
+    )
+
+# Строки, изменённые писателями старой версии во время заполнения пачками; перекопируются под блокировкой
+TYPED_MIGRATION_DIRTY_SQL = """
+    CREATE TABLE IF NOT EXISTS typed_migration_dirty (
+        table_name TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        PRIMARY KEY (table_name, id)
+    );
+
+    CREATE OR REPLACE FUNCTION typed_migration_mark_dirty() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO typed_migration_dirty (table_name, id) VALUES (TG_TABLE_NAME, NEW.id) ON CONFLICT DO NOTHING;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+# Онлайн-перевод текстовых колонок старой схемы в типизированные: новые колонки заполняются пачками
+# с коммитом после каждой, а замена колонок выполняется одной короткой транзакцией в конце.
+# Временный триггер отмечает строки, которые успели изменить во время заполнения, и под блокировкой
+# они копируются заново, поэтому upsert-ы работающих воркеров не теряются при замене колонок
+def migrate_typed_columns(conn):
+    batch_size = int(os.getenv("MIGRATION_BATCH_SIZE", "5000"))
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT table_name, data_type FROM information_schema.columns
+        WHERE (table_name, column_name) IN (('establishment_data', 'rate'), ('reviews', 'rating'))
+    """)
+    text_tables = {table for table, data_type in cursor.fetchall() if data_type == "text"}
+    if text_tables:
+        cursor.execute(TYPED_MIGRATION_DIRTY_SQL)
+        conn.commit()
+    if "establishment_data" in text_tables:
+        log_print("Перевод establishment_data на типизированные колонки...")
+        cursor.execute("""
+            ALTER TABLE establishment_data ADD COLUMN IF NOT EXISTS rate_typed NUMERIC(2, 1);
+            ALTER TABLE establishment_data ADD COLUMN IF NOT EXISTS rate_count_typed INTEGER;
+            DROP TRIGGER IF EXISTS establishment_data_typed_dirty ON establishment_data;
+            CREATE TRIGGER establishment_data_typed_dirty
+                AFTER INSERT OR UPDATE OF rate, rate_count ON establishment_data
+                FOR EACH ROW EXECUTE FUNCTION typed_migration_mark_dirty();
+        """)
+        conn.commit()
+        select_sql = "SELECT id, rate, rate_count FROM establishment_data e WHERE {where} ORDER BY id LIMIT %s"
+        update_sql = """
+            UPDATE establishment_data AS e SET
+                rate_typed = v.rate,
+                rate_count_typed = v.rate_count,
+                name = NULLIF(e.name, 'null'),
+                address = NULLIF(e.address, 'null'),
+                phone = NULLIF(e.phone, 'null'),
+                site = NULLIF(e.site, 'null'),
+                average_bill = NULLIF(e.average_bill, 'null')
+            FROM (VALUES %s) AS v (id, rate, rate_count)
+            WHERE e.id = v.id
+        """
+        convert = lambda row: (row[0], parse_rate(row[1]), parse_count(row[2]))
+        template = "(%s, %s::numeric, %s::integer)"
+        _migrate_to_typed(conn, "establishment_data", "e", select_sql, update_sql, template, convert, batch_size)
+        cursor.execute("""
+            DROP TRIGGER establishment_data_typed_dirty ON establishment_data;
+            ALTER TABLE establishment_data DROP COLUMN rate, DROP COLUMN rate_count;
+            ALTER TABLE establishment_data RENAME COLUMN rate_typed TO rate;
+            ALTER TABLE establishment_data RENAME COLUMN rate_count_typed TO rate_count;
+        """)
+        conn.commit()
+    if "reviews" in text_tables:
+        log_print("Перевод reviews на типизированные колонки...")
+        cursor.execute("""
+            ALTER TABLE reviews ADD COLUMN IF NOT EXISTS rating_typed SMALLINT;
+            ALTER TABLE reviews ADD COLUMN IF NOT EXISTS date_typed DATE;
+            DROP TRIGGER IF EXISTS reviews_typed_dirty ON reviews;
+            CREATE TRIGGER reviews_typed_dirty
+                AFTER INSERT OR UPDATE OF rating, date ON reviews
+                FOR EACH ROW EXECUTE FUNCTION typed_migration_mark_dirty();
+        """)
+        conn.commit()
+        # Относительные даты («3 дня назад») отсчитываем от времени обхода заведения
+        select_sql = """
+            SELECT r.id, r.rating, r.date, cs.finished_at FROM reviews r
+            LEFT JOIN establishment_data e ON e.id = r.establishment_id
+            LEFT JOIN crawl_state cs ON cs.href = e.href
+            WHERE {where} ORDER BY r.id LIMIT %s
+        """
+        update_sql = """
+            UPDATE reviews AS r SET
+                rating_typed = v.rating,
+                date_typed = v.date,
+                author = NULLIF(r.author, 'N/A'),
+                review_text = NULLIF(r.review_text, 'N/A')
+            FROM (VALUES %s) AS v (id, rating, date)
+            WHERE r.id = v.id
+        """
+        convert = lambda row: (
+            row[0], parse_review_rating(row[1]), parse_review_date(row[2], row[3].date() if row[3] else None)
+        )
+        template = "(%s, %s::smallint, %s::date)"
+        _migrate_to_typed(conn, "reviews", "r", select_sql, update_sql, template, convert, batch_size)
+        cursor.execute("""
+            DROP TRIGGER reviews_typed_dirty ON reviews;
+            ALTER TABLE reviews DROP COLUMN rating, DROP COLUMN date;
+            ALTER TABLE reviews RENAME COLUMN rating_typed TO rating;
+            ALTER TABLE reviews RENAME COLUMN date_typed TO date;
+        """)
+        conn.commit()
+    if text_tables:
+        cursor.execute("DROP TABLE typed_migration_dirty; DROP FUNCTION typed_migration_mark_dirty();")
+        conn.commit()
+
+# Заполнение новых колонок: пачками без блокировки, затем под блокировкой от записи — строки, вставленные
+# после последней пачки, и строки, изменённые за время заполнения. Блокировка остаётся до коммита вызывающего
+def _migrate_to_typed(conn, table, alias, select_sql, update_sql, template, convert, batch_size):
+    cursor = conn.cursor()
+    by_id = select_sql.format(where=f"{alias}.id > %s")
+    last_id = _backfill_in_batches(conn, by_id, update_sql, template, convert, batch_size, 0)
+    cursor.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+    _backfill_in_batches(conn, by_id, update_sql, template, convert, batch_size, last_id, commit=False)
+    dirty = select_sql.format(
+        where=f"{alias}.id > %s AND {alias}.id IN (SELECT d.id FROM typed_migration_dirty d WHERE d.table_name = '{table}')"
+    )
+    _backfill_in_batches(conn, dirty, update_sql, template, convert, batch_size, 0, commit=False)
+
+# Заполнение пачками по возрастанию id; возвращает последний обработанный id
+def _backfill_in_batches(conn, select_sql, update_sql, template, convert, batch_size, last_id, commit=True):
+    cursor = conn.cursor()
+    total = 0
+    while True:
+        cursor.execute(select_sql, (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return last_id
+        execute_values(cursor, update_sql, [convert(row) for row in rows], template=template, page_size=batch_size)
+        if commit:
+            conn.commit()
+        last_id = rows[-1][0]
+        total += len(rows)
+        log_print(f"Миграция: обработано {total} строк (id до {last_id}).")
+
+# Приращение агрегатов по набору отзывов {source} с колонками establishment_id, rating, date.
+# Используется триггером на вставку (transition table new_rows) и начальным заполнением по диапазону id
+REVIEW_STATS_UPSERT_SQL = """
+    INSERT INTO establishment_review_stats AS s (
+        establishment_id, review_count, rating_count, rating_sum,
+        rating_1, rating_2, rating_3, rating_4, rating_5, latest_review_date
+    )
+    SELECT establishment_id, count(*), count(rating), coalesce(sum(rating), 0),
+           count(*) FILTER (WHERE rating = 1), count(*) FILTER (WHERE rating = 2), count(*) FILTER (WHERE rating = 3),
+           count(*) FILTER (WHERE rating = 4), count(*) FILTER (WHERE rating = 5), max(date)
+    FROM {source} AS src
+    WHERE establishment_id IS NOT NULL
+    GROUP BY establishment_id
+    ORDER BY establishment_id
+    ON CONFLICT (establishment_id) DO UPDATE SET
+        review_count = s.review_count + EXCLUDED.review_count,
+        rating_count = s.rating_count + EXCLUDED.rating_count,
+        rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+        rating_1 = s.rating_1 + EXCLUDED.rating_1,
+        rating_2 = s.rating_2 + EXCLUDED.rating_2,
+        rating_3 = s.rating_3 + EXCLUDED.rating_3,
+        rating_4 = s.rating_4 + EXCLUDED.rating_4,
+        rating_5 = s.rating_5 + EXCLUDED.rating_5,
+        latest_review_date = GREATEST(s.latest_review_date, EXCLUDED.latest_review_date),
+        updated_at = now();
+
+    INSERT INTO review_daily_stats AS s (
+        establishment_id, day, review_count, rating_count, rating_sum,
+        rating_1, rating_2, rating_3, rating_4, rating_5
+    )
+    SELECT establishment_id, date, count(*), count(rating), coalesce(sum(rating), 0),
+           count(*) FILTER (WHERE rating = 1), count(*) FILTER (WHERE rating = 2), count(*) FILTER (WHERE rating = 3),
+           count(*) FILTER (WHERE rating = 4), count(*) FILTER (WHERE rating = 5)
+    FROM {source} AS src
+    WHERE establishment_id IS NOT NULL AND date IS NOT NULL
+    GROUP BY establishment_id, date
+    ORDER BY establishment_id, date
+    ON CONFLICT (establishment_id, day) DO UPDATE SET
+        review_count = s.review_count + EXCLUDED.review_count,
+        rating_count = s.rating_count + EXCLUDED.rating_count,
+        rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+        rating_1 = s.rating_1 + EXCLUDED.rating_1,
+        rating_2 = s.rating_2 + EXCLUDED.rating_2,
+        rating_3 = s.rating_3 + EXCLUDED.rating_3,
+        rating_4 = s.rating_4 + EXCLUDED.rating_4,
+        rating_5 = s.rating_5 + EXCLUDED.rating_5;
+"""
+
+# Полнотекстовый поиск по отзывам и агрегаты по заведениям. Колонка search_vector заполняется триггером,
+# агрегаты — триггерами на вставку (приращение) и на удаление/изменение (пересчёт затронутых заведений).
+# Существующие строки заполняются пачками с коммитом после каждой, прогресс хранится в job_watermarks
+def migrate_review_search_and_stats(conn):
+    batch_size = int(os.getenv("MIGRATION_BATCH_SIZE", "5000"))
+    cursor = conn.cursor()
+    cursor.execute("""
+        ALTER TABLE reviews ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+        CREATE TABLE IF NOT EXISTS establishment_review_stats (
+            establishment_id INTEGER PRIMARY KEY REFERENCES establishment_data(id) ON DELETE CASCADE,
+            review_count INTEGER NOT NULL DEFAULT 0,
+            rating_count INTEGER NOT NULL DEFAULT 0,
+            rating_sum BIGINT NOT NULL DEFAULT 0,
+            rating_1 INTEGER NOT NULL DEFAULT 0,
+            rating_2 INTEGER NOT NULL DEFAULT 0,
+            rating_3 INTEGER NOT NULL DEFAULT 0,
+            rating_4 INTEGER NOT NULL DEFAULT 0,
+            rating_5 INTEGER NOT NULL DEFAULT 0,
+            avg_rating DOUBLE PRECISION GENERATED ALWAYS AS (rating_sum::float8 / NULLIF(rating_count, 0)) STORED,
+            latest_review_date DATE,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        -- Те же суммы по дням: окна «за последние N дней» читаются по первичному ключу
+        CREATE TABLE IF NOT EXISTS review_daily_stats (
+            establishment_id INTEGER NOT NULL REFERENCES establishment_data(id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            review_count INTEGER NOT NULL DEFAULT 0,
+            rating_count INTEGER NOT NULL DEFAULT 0,
+            rating_sum BIGINT NOT NULL DEFAULT 0,
+            rating_1 INTEGER NOT NULL DEFAULT 0,
+            rating_2 INTEGER NOT NULL DEFAULT 0,
+            rating_3 INTEGER NOT NULL DEFAULT 0,
+            rating_4 INTEGER NOT NULL DEFAULT 0,
+            rating_5 INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (establishment_id, day)
+        );
+        CREATE INDEX IF NOT EXISTS review_daily_stats_day_idx ON review_daily_stats (day);
+    """)
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION review_stats_on_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            {REVIEW_STATS_UPSERT_SQL.format(source="new_rows")}
+            RETURN NULL;
+        END
+        $$;
+
+        -- Полный пересчёт агрегатов выбранных заведений по индексу (establishment_id, date)
+        CREATE OR REPLACE FUNCTION review_stats_refresh(ids INTEGER[]) RETURNS void LANGUAGE plpgsql AS $$
+        BEGIN
+            DELETE FROM establishment_review_stats WHERE establishment_id = ANY(ids);
+            DELETE FROM review_daily_stats WHERE establishment_id = ANY(ids);
+            {REVIEW_STATS_UPSERT_SQL.format(
+                source="(SELECT establishment_id, rating, date FROM reviews WHERE establishment_id = ANY(ids))"
+            )}
+        END
+        $$;
+
+        -- Удаление или изменение оценки, даты или заведения: пересчитываем только затронутые заведения
+        CREATE OR REPLACE FUNCTION review_stats_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM review_stats_refresh(ARRAY(
+                SELECT DISTINCT establishment_id FROM old_rows WHERE establishment_id IS NOT NULL
+            ));
+            RETURN NULL;
+        END
+        $$;
+        CREATE OR REPLACE FUNCTION review_stats_on_update() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM review_stats_refresh(ARRAY(
+                SELECT DISTINCT unnest(ARRAY[o.establishment_id, n.establishment_id])
+                FROM old_rows o JOIN new_rows n ON n.id = o.id
+                WHERE (o.establishment_id, o.rating, o.date) IS DISTINCT FROM (n.establishment_id, n.rating, n.date)
+            ));
+            RETURN NULL;
+        END
+        $$;
+    """)
+    conn.commit()
+
+    cursor.execute("SELECT tgname FROM pg_trigger WHERE tgrelid = 'reviews'::regclass AND NOT tgisinternal")
+    triggers = {name for (name,) in cursor.fetchall()}
+    cursor.execute("SELECT 1 FROM job_watermarks WHERE job = 'review_search_boundary'")
+    if "reviews_search_vector" not in triggers or cursor.fetchone() is None:
+        if "reviews_search_vector" not in triggers:
             cursor.execute("""
-                INSERT INTO reviews (establishment_id, author, rating, review_text, date)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (
-                establishment_id,
-                review.get("author", "N/A"),
-                review.get("rating", "N/A"),
-                review.get("text", "N/A"),
-                review.get("date", "N/A")
-            ))
+                CREATE TRIGGER reviews_search_vector BEFORE INSERT OR UPDATE OF review_text ON reviews
+                FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_vector, 'pg_catalog.russian', review_text)
+            """)
+        # Строки выше границы заполняет триггер, не выше — заполнение пачками ниже, один раз за всё время
+        cursor.execute("SELECT coalesce(max(id), 0) FROM reviews")
+        set_job_watermark(cursor, "review_search_boundary", cursor.fetchone()[0])
+        conn.commit()
+    if "reviews_stats_insert" not in triggers:
+        # CREATE TRIGGER ждёт завершения пишущих транзакций и блокирует новые до коммита, поэтому
+        # всё, что выше границы, посчитает триггер, а всё, что не выше, — заполнение ниже
+        cursor.execute("""
+            CREATE TRIGGER reviews_stats_insert AFTER INSERT ON reviews
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION review_stats_on_insert();
+            CREATE TRIGGER reviews_stats_delete AFTER DELETE ON reviews
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION review_stats_on_delete();
+            CREATE TRIGGER reviews_stats_update AFTER UPDATE ON reviews
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION review_stats_on_update();
+        """)
+        cursor.execute("SELECT coalesce(max(id), 0) FROM reviews")
+        set_job_watermark(cursor, "review_stats_boundary", cursor.fetchone()[0])
         conn.commit()
-        log_print(f"Сохранено {len(reviews_list)} отзывов для заведения ID {establishment_id}")
+
+    boundary = get_job_watermark(cursor, "review_search_boundary")
+    last_id = get_job_watermark(cursor, "review_search_backfill")
+    while last_id < boundary:
+        upper = min(last_id + batch_size, boundary)
+        cursor.execute("""
+            UPDATE reviews SET search_vector = to_tsvector('pg_catalog.russian', coalesce(review_text, ''))
+            WHERE id > %s AND id <= %s AND search_vector IS NULL
+        """, (last_id, upper))
+        set_job_watermark(cursor, "review_search_backfill", upper)
+        conn.commit()
+        last_id = upper
+        log_print(f"Миграция: поисковый индекс заполнен до id {last_id} из {boundary}.")
+
+    boundary = get_job_watermark(cursor, "review_stats_boundary")
+    last_id = get_job_watermark(cursor, "review_stats_backfill")
+    while last_id < boundary:
+        upper = min(last_id + batch_size, boundary)
+        cursor.execute(REVIEW_STATS_UPSERT_SQL.format(
+            source="(SELECT establishment_id, rating, date FROM reviews WHERE id > %(lower)s AND id <= %(upper)s)"
+        ), {"lower": last_id, "upper": upper})
+        set_job_watermark(cursor, "review_stats_backfill", upper)
+        conn.commit()
+        last_id = upper
+        log_print(f"Миграция: агрегаты отзывов посчитаны до id {last_id} из {boundary}.")
+
+# Пересчёт хэшей, записанных до нормализации пробелов, для строк, у которых хэш меняется.
+# Если после пересчёта у заведения совпали два отзыва, остаётся строка с меньшим id
+REHASH_BATCH_SQL = f"""
+    CREATE TEMP TABLE rehash_batch ON COMMIT DROP AS
+    SELECT id, establishment_id, {REVIEW_HASH_SQL} AS new_hash FROM reviews
+    WHERE id > %(lower)s AND id <= %(upper)s;
+    DELETE FROM rehash_batch b USING reviews r WHERE r.id = b.id AND r.content_hash = b.new_hash;
+
+    DELETE FROM reviews r USING rehash_batch b
+    WHERE r.establishment_id = b.establishment_id AND r.content_hash = b.new_hash AND r.id > b.id;
+    DELETE FROM reviews r USING rehash_batch b, rehash_batch d
+    WHERE r.id = b.id AND d.establishment_id = b.establishment_id AND d.new_hash = b.new_hash AND d.id < b.id;
+    DELETE FROM reviews r USING rehash_batch b, reviews o
+    WHERE r.id = b.id AND o.establishment_id = b.establishment_id AND o.content_hash = b.new_hash AND o.id < b.id;
+
+    UPDATE reviews r SET content_hash = b.new_hash FROM rehash_batch b WHERE r.id = b.id;
+"""
+
+# Один проход по отзывам, сохранённым до нормализации; прогресс хранится в job_watermarks
+def migrate_review_hashes(conn):
+    batch_size = int(os.getenv("MIGRATION_BATCH_SIZE", "5000"))
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM job_watermarks WHERE job = 'review_hash_boundary'")
+    if cursor.fetchone() is None:
+        # Строки выше границы уже пишутся с новым хэшем
+        cursor.execute("SELECT coalesce(max(id), 0) FROM reviews")
+        set_job_watermark(cursor, "review_hash_boundary", cursor.fetchone()[0])
+        conn.commit()
+    boundary = get_job_watermark(cursor, "review_hash_boundary")
+    last_id = get_job_watermark(cursor, "review_hash_backfill")
+    while last_id < boundary:
+        upper = min(last_id + batch_size, boundary)
+        cursor.execute(REHASH_BATCH_SQL, {"lower": last_id, "upper": upper})
+        set_job_watermark(cursor, "review_hash_backfill", upper)
+        conn.commit()
+        last_id = upper
+        log_print(f"Миграция: хэши отзывов пересчитаны до id {last_id} из {boundary}.")
+
+# Удаление накопившихся дублей и создание уникальных ключей для upsert
+def migrate_unique_keys(cursor):
+    cursor.execute("SELECT to_regclass('establishment_data_href_key') IS NULL")
+    if cursor.fetchone()[0]:
+        log_print("Удаление дублей заведений и создание уникального ключа по href...")
+        cursor.execute("""
+            CREATE TEMP TABLE establishment_duplicates ON COMMIT DROP AS
+            SELECT id, keep_id FROM (
+                SELECT id, max(id) OVER (PARTITION BY href) AS keep_id FROM establishment_data
+            ) ranked
+            WHERE id <> keep_id;
+
+            UPDATE reviews r SET establishment_id = d.keep_id
+            FROM establishment_duplicates d WHERE r.establishment_id = d.id;
+            UPDATE crawl_state cs SET establishment_id = d.keep_id
+            FROM establishment_duplicates d WHERE cs.establishment_id = d.id;
+            DELETE FROM establishment_data e USING establishment_duplicates d WHERE e.id = d.id;
+
+            CREATE UNIQUE INDEX establishment_data_href_key ON establishment_data (href);
+        """)
+    cursor.execute("SELECT to_regclass('reviews_establishment_hash_key') IS NULL")
+    if cursor.fetchone()[0]:
+        log_print("Расчёт хэшей отзывов и удаление дублей...")
+        # Формула совпадает с review_content_hash
+        cursor.execute(f"""
+            UPDATE reviews
+            SET content_hash = {REVIEW_HASH_SQL}
+            WHERE content_hash IS NULL;
+
+            DELETE FROM reviews a USING reviews b
+            WHERE a.establishment_id = b.establishment_id
+              AND a.content_hash = b.content_hash
+              AND a.id > b.id;
+
+            CREATE UNIQUE INDEX reviews_establishment_hash_key ON reviews (establishment_id, content_hash);
+        """)
+
+# Общий пул соединений с PostgreSQL для всех потоков
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+_db_pool = None
+_db_pool_lock = threading.Lock()
+# ThreadedConnectionPool не ждёт свободного соединения, а бросает PoolError, поэтому ограничиваем семафором
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+def get_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = pg_pool.ThreadedConnectionPool(1, DB_POOL_SIZE, **db_params)
+        return _db_pool
+
+# Соединение из пула: commit при успехе, rollback при ошибке
+@contextmanager
+def db_connection():
+    with _db_pool_slots:
+        pool = get_db_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+
+def close_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
+
+# Функция сохранения пачки заведений вместе с отзывами одной транзакцией (upsert по href и хэшу отзыва)
+def save_establishments_to_db(batch):
+    # ON CONFLICT DO UPDATE не может дважды обновить одну строку, поэтому в пачке оставляем последний обход;
+    # порядок href тот же, что у постановки ссылок в очередь
+    batch = [
+        item for _, item in sorted({data.get("href"): (data, reviews_list) for data, reviews_list in batch}.items())
+    ]
+    log_print(f"Сохранение пачки заведений: {len(batch)} шт.")
+    with metrics.stage("db_write"), db_connection() as conn:
+        cursor = conn.cursor()
+        rows = execute_values(cursor, """
+            INSERT INTO establishment_data (href, name, address, phone, rate, rate_count, site, average_bill)
+            VALUES %s
+            ON CONFLICT (href) DO UPDATE SET
+                name = EXCLUDED.name,
+                address = EXCLUDED.address,
+                phone = EXCLUDED.phone,
+                rate = EXCLUDED.rate,
+                rate_count = EXCLUDED.rate_count,
+                site = EXCLUDED.site,
+                average_bill = EXCLUDED.average_bill
+            RETURNING href, id
+        """, [establishment_row(data) for data, _ in batch], fetch=True)
+        ids = dict(rows)
+        review_rows = [
+            review_row(ids[data.get("href")], review)
+            for data, reviews_list in batch
+            for review in reviews_list
+        ]
+        execute_values(cursor, """
+            INSERT INTO reviews (establishment_id, author, rating, review_text, date, content_hash)
+            VALUES %s
+            ON CONFLICT (establishment_id, content_hash) DO NOTHING
+        """, review_rows, page_size=1000)
+        # Прирост отзывов в день и изменение рейтинга с прошлого обхода сглаживаются (EWMA) для планировщика;
+        # при первом обходе прирост оценивается по отзывам за последние 90 дней
+        execute_values(cursor, f"""
+            UPDATE crawl_state AS cs
+            SET status = 'done', finished_at = now(), last_error = NULL, establishment_id = v.id,
+                lease_owner = NULL, lease_expires_at = NULL,
+                review_velocity = CASE
+                    WHEN cs.crawled_at IS NULL OR cs.last_rate_count IS NULL OR v.rate_count IS NULL THEN coalesce(
+                        cs.review_velocity,
+                        (SELECT sum(d.review_count)::float8 / 90 FROM review_daily_stats d
+                         WHERE d.establishment_id = v.id AND d.day >= current_date - 90)
+                    )
+                    ELSE {SCHEDULER_EWMA_ALPHA} * greatest(v.rate_count - cs.last_rate_count, 0)
+                             / greatest(extract(epoch FROM now() - cs.crawled_at) / 86400, 1.0 / 24)
+                         + {1 - SCHEDULER_EWMA_ALPHA} * coalesce(cs.review_velocity, 0)
+                END,
+                rate_volatility = CASE
+                    WHEN cs.last_rate IS NULL OR v.rate IS NULL THEN cs.rate_volatility
+                    ELSE {SCHEDULER_EWMA_ALPHA} * abs(v.rate - cs.last_rate)
+                         + {1 - SCHEDULER_EWMA_ALPHA} * coalesce(cs.rate_volatility, 0)
+                END,
+                last_rate = coalesce(v.rate, cs.last_rate),
+                last_rate_count = coalesce(v.rate_count, cs.last_rate_count),
+                crawled_at = now()
+            FROM (VALUES %s) AS v (href, id, rate, rate_count)
+            WHERE cs.href = v.href
+        """, [
+            (href, ids[href], row[4], row[5])
+            for href, row in ((data.get("href"), establishment_row(data)) for data, _ in batch)
+        ], template="(%s, %s, %s::numeric, %s::integer)")
+    log_print(f"Сохранено заведений: {len(batch)}, отзывов: {len(review_rows)}. ID: {list(ids.values())}")
+    return ids
+
+# Параметры очереди заданий
+QUEUE_LEASE_SECONDS = int(os.getenv("QUEUE_LEASE_SECONDS", "900"))  # Время аренды задания воркером
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))  # После стольких неудач задание уходит в dead
+QUEUE_RETRY_BASE_SECONDS = int(os.getenv("QUEUE_RETRY_BASE_SECONDS", "300"))  # Базовая задержка повтора, удваивается с каждой попыткой
+
+# Параметры планировщика: приоритет = дни с последнего обхода * (отзывов в день + вес устаревания + вес изменчивости * изменчивость),
+# то есть примерно сколько нового накопилось у заведения. Новые заведения получают фиксированный приоритет
+SCHEDULER_NEW_VENUE_SCORE = float(os.getenv("SCHEDULER_NEW_VENUE_SCORE", "50"))  # Приоритет заведения, которое ещё не обходили
+SCHEDULER_STALENESS_WEIGHT = float(os.getenv("SCHEDULER_STALENESS_WEIGHT", "1"))  # Вклад каждого дня без обхода
+SCHEDULER_VOLATILITY_WEIGHT = float(os.getenv("SCHEDULER_VOLATILITY_WEIGHT", "20"))  # Вес изменения рейтинга между обходами
+SCHEDULER_EWMA_ALPHA = float(os.getenv("SCHEDULER_EWMA_ALPHA", "0.5"))  # Сглаживание прироста отзывов и изменчивости
+SCHEDULER_REFRESH_HOURS = float(os.getenv("SCHEDULER_REFRESH_HOURS", "0"))  # Возвращать в очередь обойдённые раньше, 0 — не возвращать
+SCHEDULER_RERANK_SECONDS = float(os.getenv("SCHEDULER_RERANK_SECONDS", "60"))  # Как часто пересчитывать приоритеты
+SCHEDULER_LOCK_KEY = 7_161_019  # pg_try_advisory_xact_lock: пересчёт выполняет один процесс
+
+# Бюджет запросов в духе token bucket, хранится в PostgreSQL и общий для всех воркеров.
+# Ведро пополняется со скоростью per_hour в час до burst; take() в транзакции захвата задания списывает cost
+class TokenBucket:
+    def __init__(self, name, per_hour, burst):
+        self.name = name
+        self.rate = per_hour / 3600.0
+        self.burst = max(1.0, burst)
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    # 0 — токены списаны, иначе сколько секунд ждать до следующего токена
+    def take(self, cursor, cost=1.0):
+        if not self.enabled:
+            return 0.0
+        cursor.execute("""
+            INSERT INTO rate_limit_buckets (name, tokens) VALUES (%(name)s, %(burst)s)
+            ON CONFLICT (name) DO NOTHING
+        """, {"name": self.name, "burst": self.burst})
+        cursor.execute("""
+            WITH bucket AS (
+                SELECT name, least(%(burst)s, tokens + %(rate)s * extract(epoch FROM clock_timestamp() - updated_at)) AS available
+                FROM rate_limit_buckets WHERE name = %(name)s
+                FOR UPDATE
+            )
+            UPDATE rate_limit_buckets AS b
+            SET tokens = bucket.available - CASE WHEN bucket.available >= %(cost)s THEN %(cost)s ELSE 0 END,
+                updated_at = clock_timestamp()
+            FROM bucket
+            WHERE b.name = bucket.name
+            RETURNING bucket.available
+        """, {"name": self.name, "burst": self.burst, "rate": self.rate, "cost": cost})
+        available = cursor.fetchone()[0]
+        if available >= cost:
+            return 0.0
+        return (cost - available) / self.rate
+
+_crawl_budget_per_hour = float(os.getenv("CRAWL_BUDGET_PER_HOUR", "0"))  # Заведений в час на все воркеры, 0 — без ограничения
+crawl_budget = TokenBucket(
+    "crawl", _crawl_budget_per_hour,
+    float(os.getenv("CRAWL_BUDGET_BURST", str(max(1.0, _crawl_budget_per_hour / 12)))),  # Запас на всплеск, по умолчанию 5 минут бюджета
+)
+_last_rerank = 0.0
+_rerank_lock = threading.Lock()
+
+# Пересчёт приоритетов ожидающих заданий; с SCHEDULER_REFRESH_HOURS устаревшие обойдённые заведения
+# возвращаются в очередь и соревнуются за бюджет с новыми
+def rerank_crawl_queue(cursor):
+    cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (SCHEDULER_LOCK_KEY,))
+    if not cursor.fetchone()[0]:
+        return
+    # Строки блокируются в порядке href, как и в register_crawl_hrefs, поэтому взаимной блокировки с постановкой
+    # ссылок нет; занятые воркером или записью строки пропускаются и пересчитываются при следующем вызове
+    if SCHEDULER_REFRESH_HOURS > 0:
+        cursor.execute("""
+            WITH stale AS (
+                SELECT href FROM crawl_state
+                WHERE status = 'done' AND crawled_at < now() - make_interval(secs => %s)
+                ORDER BY href
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE crawl_state cs SET status = 'pending', attempts = 0, available_at = now()
+            FROM stale WHERE cs.href = stale.href
+        """, (SCHEDULER_REFRESH_HOURS * 3600,))
+    cursor.execute("""
+        WITH queued AS (
+            SELECT href FROM crawl_state
+            WHERE status = 'pending'
+            ORDER BY href
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE crawl_state cs SET priority = CASE
+            WHEN cs.crawled_at IS NULL THEN %(new_score)s
+            ELSE extract(epoch FROM now() - cs.crawled_at) / 86400 * (
+                coalesce(cs.review_velocity, 0) + %(staleness)s + %(volatility)s * coalesce(cs.rate_volatility, 0)
+            )
+        END
+        FROM queued WHERE cs.href = queued.href
+    """, {
+        "new_score": SCHEDULER_NEW_VENUE_SCORE,
+        "staleness": SCHEDULER_STALENESS_WEIGHT,
+        "volatility": SCHEDULER_VOLATILITY_WEIGHT,
+    })
+
+# Пересчёт не чаще SCHEDULER_RERANK_SECONDS в процессе; отдельной транзакцией, чтобы не держать блокировки захвата
+def maybe_rerank_crawl_queue(force=False):
+    global _last_rerank
+    with _rerank_lock:
+        if not force and time.monotonic() - _last_rerank < SCHEDULER_RERANK_SECONDS:
+            return
+        _last_rerank = time.monotonic()
+    with db_connection() as conn:
+        rerank_crawl_queue(conn.cursor())
+
+# Постановка собранных ссылок в очередь; свежие обработанные и арендованные задания не трогаем
+def register_crawl_hrefs(source_url, title, hrefs, freshness_hours):
+    freshness_seconds = float(freshness_hours) * 3600
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # execute_values допускает только один плейсхолдер, поэтому окно свежести подставляется числом.
+        # Ссылки отсортированы: строки блокируются в порядке href, как и при пересчёте приоритетов
+        execute_values(cursor, f"""
+            INSERT INTO crawl_state (href, source_url, title)
+            VALUES %s
+            ON CONFLICT (href) DO UPDATE SET
+                source_url = EXCLUDED.source_url,
+                title = EXCLUDED.title,
+                status = 'pending',
+                attempts = 0,
+                available_at = now(),
+                lease_owner = NULL,
+                lease_expires_at = NULL
+            WHERE NOT (crawl_state.status = 'done'
+                       AND crawl_state.finished_at > now() - make_interval(secs => {freshness_seconds}))
+              AND NOT (crawl_state.status = 'in_progress' AND crawl_state.lease_expires_at > now())
+        """, [(href, source_url, title) for href in sorted(set(hrefs))], page_size=1000)
+    # Новые ссылки сразу встают в общую очередь по приоритету
+    maybe_rerank_crawl_queue(force=True)
+
+# Постановка ссылок в очередь порциями прямо во время сбора: воркеры начинают обход, не дожидаясь
+# конца прокрутки, и не завершаются по QUEUE_IDLE_EXIT, пока сборщик листает выдачу
+class LinkRegistrar:
+    def __init__(self, source_url, title, freshness_hours, limit, batch_size=50, flush_interval=30):
+        self.source_url = source_url
+        self.title = title
+        self.freshness_hours = freshness_hours
+        self.limit = limit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()  # Тайлы собираются в нескольких потоках
+        self._seen = set()
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+    # Число разных заведений, переданных в очередь или ожидающих постановки
+    @property
+    def count(self):
+        return len(self._seen)
+
+    def add(self, hrefs):
+        with self._lock:
+            for href in hrefs:
+                key = org_id(href) or href
+                if key in self._seen or len(self._seen) >= self.limit:
+                    continue
+                self._seen.add(key)
+                self._buffer.append(href)
+            if len(self._buffer) >= self.batch_size or (self._buffer and time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        self._last_flush = time.monotonic()
+        try:
+            register_crawl_hrefs(self.source_url, self.title, batch, self.freshness_hours)
+            log_print(f"В очередь передано {len(batch)} ссылок, всего собрано {len(self._seen)}.")
+        except Exception as e:
+            # Порция вернётся в буфер и уйдёт со следующей
+            log_print(f"Ошибка постановки ссылок в очередь: {e}")
+            self._buffer = batch + self._buffer
+
+# Число заданий, готовых к обработке, для метрики глубины очереди
+def count_queued_jobs():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT count(*) FROM crawl_state WHERE status = 'pending' AND available_at <= now()")
+        return cursor.fetchone()[0]
+
+# Есть ли незавершённые задания по этому поиску (тогда ссылки заново не собираем).
+# Считаются только ни разу не обработанные ссылки: повторные обходы, которые ставит планировщик,
+# лежат в очереди постоянно и не означают прерванный сбор
+def has_unfinished_jobs(source_url):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT count(*) FROM crawl_state
+            WHERE source_url = %s AND status IN ('pending', 'in_progress') AND crawled_at IS NULL
+        """, (source_url,))
+        return cursor.fetchone()[0]
+
+# Захват самого ценного задания в пределах бюджета; SKIP LOCKED гарантирует, что два воркера не получат одну ссылку.
+# Возвращает (href, 0), (None, секунды до следующего токена) или (None, 0), если очередь пуста
+def claim_crawl_job(worker_id):
+    maybe_rerank_crawl_queue()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Задания с истёкшей арендой и исчерпанными попытками переводим в dead
+        cursor.execute("""
+            UPDATE crawl_state SET status = 'dead', lease_owner = NULL, lease_expires_at = NULL,
+                last_error = coalesce(last_error, 'Истекла аренда задания')
+            WHERE status = 'in_progress' AND lease_expires_at < now() AND attempts >= %s
+        """, (QUEUE_MAX_ATTEMPTS,))
+        cursor.execute("""
+            SELECT href, crawled_at IS NULL FROM crawl_state
+            WHERE (status = 'pending' AND available_at <= now())
+               OR (status = 'in_progress' AND lease_expires_at < now())
+            ORDER BY priority DESC, available_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """)
+        row = cursor.fetchone()
+        if row is None:
+            return None, 0.0
+        href, is_new = row
+        # Токен списывается только вместе с захватом задания; без токена строка освобождается при коммите
+        wait_seconds = crawl_budget.take(cursor)
+        if wait_seconds > 0:
+            return None, wait_seconds
+        cursor.execute("""
+            UPDATE crawl_state SET
+                status = 'in_progress',
+                lease_owner = %s,
+                lease_expires_at = now() + make_interval(secs => %s),
+                attempts = attempts + 1,
+                started_at = now()
+            WHERE href = %s
+        """, (worker_id, QUEUE_LEASE_SECONDS, href))
+    metrics.inc("parser_jobs_dispatched_total", help_text="Выданные воркерам задания", kind="new" if is_new else "refresh")
+    return href, 0.0
+
+# Продление аренды перед передачей страницы следующему этапу: прокрутка, разбор и очередь записи
+# вместе могут занять дольше QUEUE_LEASE_SECONDS. False — аренду уже перехватил другой воркер
+def renew_crawl_lease(href, worker_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE crawl_state SET lease_expires_at = now() + make_interval(secs => %s)
+            WHERE href = %s AND lease_owner = %s AND status = 'in_progress'
+        """, (QUEUE_LEASE_SECONDS, href, worker_id))
+        return cursor.rowcount == 1
+
+# Продление аренды с журналированием; при ошибке базы этап продолжает работу на старой аренде
+def keep_crawl_lease(href, worker_id):
+    if worker_id is None:
+        return True
+    try:
+        if renew_crawl_lease(href, worker_id):
+            return True
     except Exception as e:
-        log_print(f"Ошибка сохранения отзывов: {e}")
-    finally:
-        if 'conn' in locals():
-            conn.close()
+        log_print(f"Ошибка продления аренды {href}: {e}")
+        return True
+    metrics.inc("parser_leases_lost_total", help_text="Задания, аренду которых перехватил другой воркер")
+    log_print(f"Аренда {href} перехвачена другим воркером, результат отброшен.")
+    return False
+
+# Неудача: повтор с экспоненциальной задержкой или перевод в dead
+def mark_crawl_failed(href, error):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE crawl_state SET
+                status = CASE WHEN attempts >= %s THEN 'dead' ELSE 'pending' END,
+                available_at = now() + make_interval(secs => %s * power(2, greatest(attempts - 1, 0))),
+                last_error = %s,
+                lease_owner = NULL,
+                lease_expires_at = NULL,
+                finished_at = now()
+            WHERE href = %s
+            RETURNING status
+        """, (QUEUE_MAX_ATTEMPTS, QUEUE_RETRY_BASE_SECONDS, error, href))
+        row = cursor.fetchone()
+    if row:
+        metrics.inc("parser_jobs_failed_total", help_text="Неудачные попытки обработки заведения", outcome="retry" if row[0] == "pending" else "dead")
+
+# Хэши уже сохранённых отзывов заведения: по ним прокрутка останавливается на известных отзывах
+def load_review_hashes(href):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT r.content_hash FROM reviews r
+            JOIN establishment_data e ON e.id = r.establishment_id
+            WHERE e.href = %s
+        """, (href,))
+        return {row[0] for row in cursor.fetchall()}
+
+# Отметка фонового задания; 0, если задание ещё не запускалось
+def get_job_watermark(cursor, job):
+    cursor.execute("SELECT last_id FROM job_watermarks WHERE job = %s", (job,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+# Отметка фонового задания по времени; None, если задание ещё не запускалось
+def get_job_watermark_at(cursor, job):
+    cursor.execute("SELECT last_at FROM job_watermarks WHERE job = %s", (job,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+# Сдвиг отметки выполняется в той же транзакции, что и запись результатов задания
+def set_job_watermark(cursor, job, last_id, last_at=None):
+    cursor.execute("""
+        INSERT INTO job_watermarks (job, last_id, last_at) VALUES (%s, %s, %s)
+        ON CONFLICT (job) DO UPDATE SET
+            last_id = GREATEST(job_watermarks.last_id, EXCLUDED.last_id),
+            last_at = GREATEST(job_watermarks.last_at, EXCLUDED.last_at),
+            updated_at = now()
+    """, (job, last_id, last_at))
+
+# Фоновый писатель: копит заведения из всех потоков и сбрасывает их в базу пачками
+class BatchWriter:
+    _STOP = object()
+
+    def __init__(self, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Ограниченная очередь: если база не успевает, потоки парсинга ждут
+        self._queue = queue.Queue(maxsize=batch_size * 4)
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, data, reviews_list):
+        self._queue.put((data, reviews_list))
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is self._STOP:
+                self._flush(batch)
+                return
+            if item is not None:
+                batch.append(item)
+                if len(batch) == 1:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        try:
+            save_establishments_to_db(batch)
+        except Exception as e:
+            log_print(f"Ошибка сохранения пачки заведений: {e}")
+            for data, _ in batch:
+                try:
+                    mark_crawl_failed(data.get("href"), str(e))
+                except Exception as me:
+                    log_print(f"Ошибка обновления состояния обхода: {me}")
+
+    def close(self):
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+# Режим извлечения: network — отзывы и данные заведения из ответов API через логи DevTools, dom — только из разметки
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "network").lower()
+
+# Группы шаблонов Network.setBlockedURLs: ресурсы, которые парсеру не нужны.
+# Шаблон сравнивается со всем URL, * — любая подстрока, поэтому расширения заканчиваются на * (query-строка).
+RESOURCE_BLOCK_GROUPS = {
+    "image": ["*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.webp*", "*.avif*", "*.ico*"],
+    "font": ["*.woff*", "*.ttf*", "*.otf*", "*.eot*"],
+    "media": ["*.mp4*", "*.webm*", "*.mp3*", "*.m3u8*"],
+    # Тайлы карты, панорамы и пробки
+    "tiles": [
+        "*core-renderer-tiles.maps.yandex.net*", "*core-sat.maps.yandex.net*", "*core-jams-rdr-cache.maps.yandex.net*",
+        "*core-stv-renderer.maps.yandex.net*", "*pano.maps.yandex.net*", "*api-maps.yandex.ru/services/coverage*",
+        "*/vmap2/tiles?*",
+    ],
+    "analytics": [
+        "*mc.yandex.ru*", "*mc.yandex.com*", "*yandex.ru/clck/*", "*yandex.ru/count/*",
+        "*googletagmanager.com*", "*google-analytics.com*", "*top-fwz1.mail.ru*",
+    ],
+    "ads": ["*an.yandex.ru*", "*yandex.ru/ads/*", "*adfox.yandex.ru*", "*ads.adfox.ru*", "*awaps.yandex.net*"],
+    # Стили по умолчанию не блокируются: от них зависит видимость сниппетов
+    "stylesheet": ["*.css*"],
+}
+
+# Блокировка ресурсов через CDP. Если с блокировкой не отрисовались нужные селекторы, драйвер работает без неё;
+# после max_fallbacks таких случаев блокировка отключается для всех новых драйверов.
+class ResourceBlocker:
+    def __init__(self, groups, extra_patterns, unblock_patterns, max_fallbacks):
+        patterns = []
+        for group in groups:
+            if group not in RESOURCE_BLOCK_GROUPS:
+                log_print(f"Неизвестная группа блокировки ресурсов: {group}")
+                continue
+            patterns.extend(RESOURCE_BLOCK_GROUPS[group])
+        patterns.extend(extra_patterns)
+        # Исключения сравниваются с самими шаблонами блокировки, а не с URL запросов:
+        # совпавший шаблон просто не передаётся в Network.setBlockedURLs
+        self.patterns = [
+            pattern for pattern in dict.fromkeys(patterns)
+            if not any(fnmatch.fnmatchcase(pattern, unblocked) for unblocked in unblock_patterns)
+        ]
+        self.enabled = bool(self.patterns)
+        self.max_fallbacks = max_fallbacks
+        self.fallbacks = 0
+        self._blocked = weakref.WeakSet()
+        self._lock = threading.Lock()
 
-# Функция создания драйвера
-def create_driver():
+    def apply(self, driver):
+        if not self.enabled:
+            return
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": self.patterns})
+        self._blocked.add(driver)
+
+    def is_blocking(self, driver):
+        return driver in self._blocked
+
+    # Снятие блокировки с драйвера после неудачной проверки селекторов
+    def fall_back(self, driver, reason):
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": []})
+        self._blocked.discard(driver)
+        metrics.inc("parser_resource_blocking_fallbacks_total", help_text="Отключений блокировки ресурсов на драйвере")
+        with self._lock:
+            self.fallbacks += 1
+            if self.enabled and self.fallbacks >= self.max_fallbacks:
+                self.enabled = False
+                log_print(f"Блокировка ресурсов отключена: селекторы не отрисовались {self.fallbacks} раз.")
+        log_print(f"Блокировка ресурсов снята с драйвера: {reason}")
+
+def _env_list(name, default=""):
+    return [item.strip() for item in os.getenv(name, default).split(",") if item.strip()]
+
+resource_blocker = ResourceBlocker(
+    groups=[group.lower() for group in _env_list("BLOCK_RESOURCES", "image,font,media,tiles,analytics,ads") if group.lower() != "none"],
+    extra_patterns=_env_list("BLOCK_URL_PATTERNS"),
+    # ALLOW_URL_PATTERNS — прежнее имя переменной, читается для совместимости
+    unblock_patterns=_env_list("UNBLOCK_PATTERNS", os.getenv("ALLOW_URL_PATTERNS", "")),
+    max_fallbacks=int(os.getenv("BLOCKING_MAX_FALLBACKS", "3")),
+)
+
+# Функция создания драйвера; network_logging включает performance-лог для перехвата ответов API
+def create_driver(network_logging=False):
     options = Options()
+    if network_logging:
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
     prefs = {"profile.managed_default_content_settings.images": 2}
     options.add_experimental_option("prefs", prefs)
     options.add_argument(f"user-agent={random.choice(USER_AGENTS)}")
@@ -149,25 +1339,257 @@ def create_driver():
     options.add_argument("--disable-software-rasterizer")
     options.add_argument("--disable-extensions")
     service = Service("/usr/local/bin/chromedriver")
-    driver = webdriver.Chrome(service=service, options=options)
+    with metrics.stage("create_driver"):
+        driver = webdriver.Chrome(service=service, options=options)
     log_print(f"Chromedriver версия: {driver.capabilities['chrome']['chromedriverVersion']}")
     log_print(f"Chrome версия: {driver.capabilities['browserVersion']}")
+    # Асинхронные ожидания (MutationObserver) укладываются в этот таймаут
+    driver.set_script_timeout(60)
+    try:
+        resource_blocker.apply(driver)
+    except Exception as e:
+        log_print(f"Не удалось включить блокировку ресурсов: {e}")
     return driver
 
-# Функция попытки решения капчи
-def solve_captcha(driver):
+# Пул прогретых драйверов, общий для всех потоков обработки заведений
+class DriverPool:
+    def __init__(self, size, max_pages, spawn_attempts=3, acquire_timeout=300):
+        self.size = size
+        self.max_pages = max_pages
+        self.spawn_attempts = spawn_attempts
+        self.acquire_timeout = acquire_timeout
+        self._idle = queue.Queue()
+        self._pages = {}
+        self._spawning = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._spawner = ThreadPoolExecutor(max_workers=size, thread_name_prefix="driver-spawn")
+        for _ in range(size):
+            self._submit_spawn()
+
+    def _submit_spawn(self):
+        with self._lock:
+            self._spawning += 1
+        self._spawner.submit(self._spawn)
+
+    # Запуск нового драйвера в фоне; после spawn_attempts неудач запуск прекращается,
+    # и недостающий драйвер снова запрашивается при следующем acquire()
+    def _spawn(self):
+        try:
+            for attempt in range(1, self.spawn_attempts + 1):
+                if self._closed:
+                    return
+                try:
+                    driver = create_driver(network_logging=EXTRACTION_MODE == "network")
+                    with self._lock:
+                        if self._closed:
+                            driver.quit()
+                            return
+                        self._pages[driver] = 0
+                    self._idle.put(driver)
+                    return
+                except Exception as e:
+                    log_print(f"Ошибка запуска драйвера для пула (попытка {attempt}/{self.spawn_attempts}): {e}")
+                    if attempt < self.spawn_attempts:
+                        time.sleep(5)
+        finally:
+            with self._lock:
+                self._spawning -= 1
+
+    # Очистка cookies и хранилищ перед выдачей драйвера следующему заведению
+    def _reset(self, driver):
+        driver.execute_script("try { window.localStorage.clear(); window.sessionStorage.clear(); } catch (e) {}")
+        parts = urlsplit(driver.current_url)
+        if parts.scheme in ("http", "https"):
+            driver.execute_cdp_cmd("Storage.clearDataForOrigin", {
+                "origin": f"{parts.scheme}://{parts.netloc}",
+                "storageTypes": "all",
+            })
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        driver.get("about:blank")
+
+    def _quit(self, driver):
+        try:
+            driver.quit()
+        except Exception as e:
+            log_print(f"Ошибка закрытия драйвера: {e}")
+
+    # Вывод драйвера из пула и запуск замены в фоне
+    def _retire(self, driver):
+        with self._lock:
+            self._pages.pop(driver, None)
+        if self._closed:
+            self._quit(driver)
+            return
+        self._spawner.submit(self._quit, driver)
+        self._submit_spawn()
+
+    # Выдача драйвера; если запустить драйверы не удаётся, бросает RuntimeError, и задание помечается неудачным
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._lock:
+                missing = self.size - len(self._pages) - self._spawning
+            if missing > 0 and not self._closed:
+                for _ in range(missing):
+                    self._submit_spawn()
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                pass
+            with self._lock:
+                starved = not self._pages and not self._spawning
+            if starved and self._idle.empty():
+                raise RuntimeError("не удалось запустить ни одного драйвера")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"нет свободного драйвера за {self.acquire_timeout} с")
+
+    # Возврат драйвера в пул; broken=True — после сбоя или нерешённой капчи
+    def release(self, driver, broken=False):
+        with self._lock:
+            self._pages[driver] = self._pages.get(driver, 0) + 1
+            pages = self._pages[driver]
+        if broken or pages >= self.max_pages or self._closed:
+            log_print(f"Драйвер выведен из пула (страниц: {pages}, сбой: {broken}).")
+            self._retire(driver)
+            return
+        try:
+            self._reset(driver)
+        except Exception as e:
+            log_print(f"Ошибка очистки драйвера, заменяем: {e}")
+            self._retire(driver)
+            return
+        self._idle.put(driver)
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            drivers = list(self._pages)
+            self._pages.clear()
+        for driver in drivers:
+            self._quit(driver)
+        self._spawner.shutdown(wait=True)
+
+# Адаптивная пауза между запросами: растёт вдвое после каждой капчи и плавно снижается, пока капч нет
+class Pacer:
+    def __init__(self, min_delay, max_delay, decrease_step, window=50):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.decrease_step = decrease_step
+        self.delay = min_delay
+        self._events = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, captcha):
+        with self._lock:
+            self._events.append(bool(captcha))
+            if captcha:
+                self.delay = min(self.max_delay, self.delay * 2)
+            else:
+                self.delay = max(self.min_delay, self.delay - self.decrease_step)
+
+    @property
+    def captcha_rate(self):
+        with self._lock:
+            return sum(self._events) / len(self._events) if self._events else 0.0
+
+    # fraction — доля полной паузы, например для прокрутки внутри уже открытой страницы
+    def pause(self, fraction=1.0):
+        time.sleep(self.delay * fraction * random.uniform(0.75, 1.25))
+
+pacer = Pacer(
+    min_delay=float(os.getenv("PACING_MIN_DELAY", "1")),
+    max_delay=float(os.getenv("PACING_MAX_DELAY", "120")),
+    decrease_step=float(os.getenv("PACING_DECREASE_STEP", "0.5")),
+)
+metrics.REGISTRY.gauge("parser_pacing_delay_seconds", "Текущая пауза между запросами").set_function(lambda: pacer.delay)
+metrics.REGISTRY.gauge("parser_captcha_rate", "Доля страниц с капчей в скользящем окне").set_function(lambda: pacer.captcha_rate)
+
+# Ждёт, пока на странице станет не меньше min_count узлов по селектору (MutationObserver), либо таймаута.
+# Возвращает итоговое число узлов.
+WAIT_FOR_NODES_JS = """
+const [selector, minCount, timeoutMs] = arguments;
+const done = arguments[arguments.length - 1];
+const count = () => document.querySelectorAll(selector).length;
+if (count() >= minCount) { done(count()); return; }
+let timer;
+const observer = new MutationObserver(() => {
+    const current = count();
+    if (current >= minCount) {
+        observer.disconnect();
+        clearTimeout(timer);
+        done(current);
+    }
+});
+observer.observe(document.documentElement, {childList: true, subtree: true});
+timer = setTimeout(() => { observer.disconnect(); done(count()); }, timeoutMs);
+"""
+
+# Ждёт, пока DOM не меняется quiet_ms миллисекунд (страница дорисовалась), либо таймаута
+WAIT_FOR_DOM_IDLE_JS = """
+const [quietMs, timeoutMs] = arguments;
+const done = arguments[arguments.length - 1];
+let quietTimer;
+const finish = () => { observer.disconnect(); clearTimeout(quietTimer); clearTimeout(hardTimer); done(true); };
+const observer = new MutationObserver(() => { clearTimeout(quietTimer); quietTimer = setTimeout(finish, quietMs); });
+observer.observe(document.documentElement, {childList: true, subtree: true, attributes: true});
+quietTimer = setTimeout(finish, quietMs);
+const hardTimer = setTimeout(finish, timeoutMs);
+"""
+
+# Ждёт добавления в DOM хотя бы одного нового узла по селектору, либо таймаута.
+# В отличие от подсчёта узлов работает и для виртуализированных списков, где их число не растёт.
+# При scrollToLast прокрутка к последнему узлу выполняется уже после подписки, чтобы не пропустить подгрузку.
+WAIT_FOR_ADDED_NODES_JS = """
+const [selector, timeoutMs, scrollToLast] = arguments;
+const done = arguments[arguments.length - 1];
+let timer;
+const observer = new MutationObserver(mutations => {
+    for (const mutation of mutations) {
+        for (const node of mutation.addedNodes) {
+            if (node.nodeType === 1 && (node.matches(selector) || node.querySelector(selector))) {
+                observer.disconnect();
+                clearTimeout(timer);
+                done(true);
+                return;
+            }
+        }
+    }
+});
+observer.observe(document.documentElement, {childList: true, subtree: true});
+timer = setTimeout(() => { observer.disconnect(); done(false); }, timeoutMs);
+if (scrollToLast) {
+    const nodes = document.querySelectorAll(selector);
+    if (nodes.length) nodes[nodes.length - 1].scrollIntoView(true);
+}
+"""
+
+def wait_for_added_nodes(driver, selector, timeout, scroll_to_last=False):
+    return driver.execute_async_script(WAIT_FOR_ADDED_NODES_JS, selector, int(timeout * 1000), scroll_to_last)
+
+def wait_for_nodes(driver, selector, min_count, timeout):
+    return driver.execute_async_script(WAIT_FOR_NODES_JS, selector, min_count, int(timeout * 1000))
+
+def wait_for_dom_idle(driver, quiet=0.5, timeout=10):
+    driver.execute_async_script(WAIT_FOR_DOM_IDLE_JS, int(quiet * 1000), int(timeout * 1000))
+
+# Функция попытки решения капчи. navigation=False — проверка внутри уже открытой страницы (при прокрутке):
+# страница без капчи тогда не засчитывается темпу, иначе каждая проверка снимала бы шаг паузы и сводила на нет backoff
+def solve_captcha(driver, navigation=True):
     try:
         log_print("Проверка наличия капчи...")
         WebDriverWait(driver, 30).until(lambda d: d.execute_script("return document.readyState") == "complete")
         
         captcha_elements = driver.find_elements(By.CSS_SELECTOR, "input.CheckboxCaptcha-Button")
+        if navigation or captcha_elements:
+            pacer.record(captcha=bool(captcha_elements))
         if not captcha_elements:
             log_print("Капча не обнаружена, продолжаем.")
             return True
         
-        log_print("Капча обнаружена, пытаемся решить...")
+        log_print(f"Капча обнаружена, пытаемся решить... Пауза между запросами увеличена до {pacer.delay:.1f} с.")
+        metrics.inc("parser_captchas_seen_total", help_text="Обнаружено капч")
         driver.execute_script("document.querySelector('div[data-type=\"checkbox\"]')?.click();")
-        time.sleep(2)
         
         captcha_button = WebDriverWait(driver, 30).until(
             EC.element_to_be_clickable((By.CSS_SELECTOR, "input.CheckboxCaptcha-Button"))
@@ -180,8 +1602,10 @@ def solve_captcha(driver):
         WebDriverWait(driver, 15).until_not(
             EC.presence_of_element_located((By.CSS_SELECTOR, "input.CheckboxCaptcha-Button"))
         )
+        WebDriverWait(driver, 30).until(lambda d: d.execute_script("return document.readyState") == "complete")
         log_print("Капча успешно решена.")
-        time.sleep(random.uniform(5, 10))
+        metrics.inc("parser_captchas_solved_total", help_text="Решено капч")
+        pacer.pause()
         return True
     except Exception as e:
         log_print(f"Ошибка при обработке капчи: {str(e)}")
@@ -195,132 +1619,602 @@ def solve_captcha(driver):
             log_print(f"Ошибка сохранения скриншота или HTML: {se}")
         return False
 
-# Функция обработки страницы заведения
-def process_establishment(url, index, total):
-    driver = None
+# Селекторы полей заведения на странице организации
+ORG_FIELD_SELECTORS = ", ".join([
+    "h1.orgpage-header-view__header",
+    "div.business-contacts-view__address-link",
+    "div.orgpage-phones-view__phone-number",
+    "span.business-summary-rating-badge-view__rating-text",
+    "span.business-header-rating-view__text",
+    "span.business-urls-view__text",
+    "span.business-features-view__valued-value",
+])
+
+# Возвращает HTML только тех узлов, из которых берутся поля заведения
+ORG_FRAGMENT_JS = """
+return Array.from(document.querySelectorAll(arguments[0])).map(el => el.outerHTML).join('');
+"""
+
+# Возвращает записи отзывов, появившихся после предыдущего вызова, и помечает их как прочитанные
+EXTRACT_NEW_REVIEWS_JS = """
+const limit = arguments[0];
+const text = (root, selector) => {
+    const el = root.querySelector(selector);
+    return el ? el.textContent.trim() : null;
+};
+const records = [];
+for (const node of document.querySelectorAll('div.business-review-view__body:not([data-vi-seen])')) {
+    if (records.length >= limit) break;
+    node.setAttribute('data-vi-seen', '1');
+    const stars = node.querySelector('div.business-rating-badge-view__stars');
+    records.push({
+        text: text(node, 'span.business-review-view__body-text'),
+        author: text(node, 'span.business-review-view__author'),
+        rating: stars ? String(stars.querySelectorAll('span.business-rating-badge-view__star._full').length) : null,
+        date: text(node, 'span.business-review-view__date'),
+    });
+}
+return records;
+"""
+
+# Каталог для сохранения сырых ответов API (пусто — не сохранять)
+NETWORK_DUMP_DIR = os.getenv("NETWORK_DUMP_DIR", "")
+
+# Пути API Яндекс.Карт, ответы которых содержат отзывы и карточку организации
+REVIEWS_API_PATH = "/maps/api/business/fetchReviews"
+ORG_API_PATH = "/maps/api/search"
+
+# Перехват JSON-ответов API из performance-лога Chrome
+class NetworkCapture:
+    def __init__(self, driver):
+        self.driver = driver
+        self._pending = {}
+        self.exhausted = False
+        # Сбрасываем записи, оставшиеся от предыдущего заведения на этом драйвере
+        driver.get_log("performance")
+
+    # Возвращает тела новых ответов: {"reviews": [...], "org": [...]}
+    def poll(self):
+        payloads = {"reviews": [], "org": []}
+        transferred = 0
+        for entry in self.driver.get_log("performance"):
+            message = json.loads(entry["message"])["message"]
+            method = message.get("method")
+            params = message.get("params", {})
+            if method == "Network.responseReceived":
+                url = params["response"]["url"]
+                if REVIEWS_API_PATH in url:
+                    self._pending[params["requestId"]] = "reviews"
+                elif ORG_API_PATH in url:
+                    self._pending[params["requestId"]] = "org"
+            elif method == "Network.loadingFinished":
+                transferred += params.get("encodedDataLength", 0)
+                if params.get("requestId") not in self._pending:
+                    continue
+                kind = self._pending.pop(params["requestId"])
+                try:
+                    body = self.driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": params["requestId"]})
+                    text = body["body"]
+                    if body.get("base64Encoded"):
+                        text = base64.b64decode(text).decode("utf-8")
+                    payload = json.loads(text)
+                except Exception as e:
+                    log_print(f"Не удалось получить тело ответа {kind}: {e}")
+                    continue
+                payloads[kind].append(payload)
+                if NETWORK_DUMP_DIR:
+                    self._dump(kind, text)
+                if kind == "reviews" and is_last_review_page(payload):
+                    self.exhausted = True
+        if transferred:
+            metrics.inc("parser_network_bytes_total", transferred, help_text="Загружено браузерами страниц заведений, байт")
+        return payloads
+
+    # Сохраняет сырой ответ API для пополнения фикстур benchmark/network_fixtures
+    def _dump(self, kind, text):
+        try:
+            os.makedirs(NETWORK_DUMP_DIR, exist_ok=True)
+            path = os.path.join(NETWORK_DUMP_DIR, f"{kind}_{time.time_ns()}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        except OSError as e:
+            log_print(f"Не удалось сохранить ответ {kind}: {e}")
+
+# Последняя ли это страница отзывов по data.params ответа fetchReviews
+def is_last_review_page(payload):
+    page_params = (payload.get("data") or {}).get("params") or {}
+    return bool(page_params.get("page") and page_params.get("totalPages") and page_params["page"] >= page_params["totalPages"])
+
+# Преобразование ответа fetchReviews в записи отзывов того же вида, что и из разметки
+def map_network_reviews(payload):
+    reviews = []
+    for item in (payload.get("data") or {}).get("reviews") or []:
+        author = item.get("author") or {}
+        rating = item.get("rating")
+        reviews.append({
+            "text": (item.get("text") or "").strip() or "N/A",
+            "author": (author.get("name") or "").strip() or "N/A",
+            "rating": str(rating) if rating is not None else "N/A",
+            "date": item.get("updatedTime") or item.get("createdTime") or "N/A",
+        })
+    return reviews
+
+# Поля заведения из ответа поиска; в словарь попадают только найденные значения
+def map_network_org(payload, url):
+    items = (payload.get("data") or {}).get("items") or []
+    item = next((item for item in items if item.get("id") and f"/{item['id']}/" in url), None)
+    if item is None:
+        return {}
+    fields = {"name": item.get("title"), "address": item.get("fullAddress") or item.get("address")}
+    phones = item.get("phones") or []
+    if phones:
+        fields["phone"] = phones[0].get("number")
+    rating = item.get("ratingData") or {}
+    if rating.get("ratingValue") is not None:
+        fields["rate"] = str(rating["ratingValue"])
+    if rating.get("ratingCount") is not None:
+        fields["rate_count"] = str(rating["ratingCount"])
+    urls = item.get("urls") or []
+    if urls:
+        fields["site"] = urls[0]
+    for feature in item.get("features") or []:
+        if str(feature.get("id", "")).startswith("average_bill"):
+            value = feature.get("value")
+            fields["average_bill"] = ", ".join(map(str, value)) if isinstance(value, list) else value
+            break
+    return {key: str(value) for key, value in fields.items() if value not in (None, "")}
+
+ORG_FIELDS = ("name", "address", "phone", "rate", "rate_count", "site", "average_bill")
+
+# Переключение сортировки отзывов на «По новизне»; False, если переключатель не найден
+def sort_reviews_by_newest(driver):
     try:
-        driver = create_driver()
-        log_print(f"Начало обработки заведения {index}/{total}: {url}")
-        time.sleep(random.uniform(5, 10))
+        driver.execute_script("document.querySelector('.rating-ranking-view')?.click();")
+        option = WebDriverWait(driver, 5).until(EC.element_to_be_clickable((
+            By.XPATH, "//*[contains(@class, 'rating-ranking-view__popup-line') and normalize-space() = 'По новизне']"
+        )))
+        driver.execute_script("arguments[0].click();", option)
+        wait_for_dom_idle(driver)
+        log_print("Отзывы отсортированы по новизне.")
+        return True
+    except Exception as e:
+        log_print(f"Не удалось отсортировать отзывы по новизне, просматриваем все: {e}")
+        return False
+
+# Непрочитанные узлы отзывов: их появление означает, что прокрутка подгрузила новые отзывы
+UNSEEN_REVIEWS_SELECTOR = "div.business-review-view__body:not([data-vi-seen])"
+REVIEW_WAIT_TIMEOUT = float(os.getenv("REVIEW_WAIT_TIMEOUT", "5"))  # Сколько ждать новых отзывов после прокрутки, сек
+
+# Запись отзыва из разметки: отсутствующие поля — "N/A", как в ответах API
+def normalize_dom_review(record):
+    return {key: value if value is not None else "N/A" for key, value in record.items()}
+
+# Есть ли среди новых отзывов уже сохранённый
+def reached_known_review(dom_records, review_payloads, known_hashes):
+    candidates = [review for payload in review_payloads for review in map_network_reviews(payload)]
+    candidates.extend(normalize_dom_review(record) for record in dom_records)
+    return any(review_content_hash(review) in known_hashes for review in candidates)
+
+# Прокрутка отзывов; возвращает сырые записи из разметки и ответы API для этапа разбора.
+# Хэши здесь считаются только при обходе по новизне, чтобы остановиться на первом сохранённом отзыве.
+def scroll_reviews(driver, url, capture, known_hashes, newest_first, max_reviews, max_attempts):
+    dom_reviews = []
+    network_payloads = {"reviews": [], "org": []}
+    collected = 0
+    attempts = 0
+    while attempts < max_attempts and collected < max_reviews:
+        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+        # Вместо фиксированной паузы ждём появления новых узлов отзывов
+        wait_for_nodes(driver, UNSEEN_REVIEWS_SELECTOR, 1, REVIEW_WAIT_TIMEOUT)
+        pacer.pause(fraction=0.1)
+        # Первый блок отзывов отрисован сервером и приходит только в разметке, поэтому узлы читаются всегда
+        new_records = driver.execute_script(EXTRACT_NEW_REVIEWS_JS, max_reviews - collected)
+        new_payloads = capture.poll() if capture else {"reviews": [], "org": []}
+        dom_reviews.extend(new_records)
+        for kind, payloads in new_payloads.items():
+            network_payloads[kind].extend(payloads)
+        # В режиме network отзыв приходит и в ответе API, и в разметке, поэтому берём больший из источников
+        network_count = sum(len((payload.get("data") or {}).get("reviews") or []) for payload in new_payloads["reviews"])
+        added = max(len(new_records), network_count)
+        collected += added
+        attempts = 0 if added else attempts + 1
+        log_print(f"Получено отзывов: {collected}, попытка {attempts}/{max_attempts}")
+        if newest_first and reached_known_review(new_records, new_payloads["reviews"], known_hashes):
+            log_print(f"Дошли до уже сохранённых отзывов для {url}.")
+            break
+        if collected >= max_reviews:
+            log_print(f"Достигнут лимит {max_reviews} отзывов для {url}.")
+            break
+        if capture and capture.exhausted:
+            log_print(f"API вернул последнюю страницу отзывов для {url}.")
+            break
+    log_print(f"Прокрутка страницы {url} завершена, получено {collected} отзывов.")
+    return dom_reviews, network_payloads
+
+# Этап разбора: поля заведения и новые отзывы без дублей из сырых данных страницы.
+# Выполняется в пуле процессов, поэтому работает только с переданными данными.
+def parse_payload(payload):
+    url = payload["href"]
+    network_org = {}
+    for org_payload in payload["network"]["org"]:
+        network_org.update(map_network_org(org_payload, url))
+    # Разметка и API пересекаются: отзыв из обоих источников даёт один хэш (пробелы нормализуются) и берётся один раз.
+    # Разметка первой — в ней серверный первый блок, которого нет в ответах API
+    candidates = [normalize_dom_review(record) for record in payload["dom_reviews"]]
+    candidates.extend(review for review_payload in payload["network"]["reviews"] for review in map_network_reviews(review_payload))
+    reviews_list = []
+    seen_hashes = set()
+    for review in candidates:
+        content_hash = review_content_hash(review)
+        if content_hash in payload["known_hashes"] or content_hash in seen_hashes:
+            continue
+        seen_hashes.add(content_hash)
+        reviews_list.append(review)
+        if len(reviews_list) >= payload["max_reviews"]:
+            break
+    # Разметку разбираем, только если ответы API покрыли не все поля
+    if all(field in network_org for field in ORG_FIELDS):
+        data = {"href": url, **network_org}
+    else:
+        data = extraction.parse_establishment_fields(url, payload["org_html"])
+        data.update(network_org)
+    return data, reviews_list
+
+# Разбор с замером времени; процессорное время считается по процессу, в котором шёл разбор
+def timed_parse_payload(payload):
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time() if multiprocessing.parent_process() else time.thread_time()
+    result = parse_payload(payload)
+    cpu_end = time.process_time() if multiprocessing.parent_process() else time.thread_time()
+    return result, time.perf_counter() - wall_start, cpu_end - cpu_start
+
+# Этап разбора между браузерами и писателем в базу: пул процессов или разбор в потоке браузера (workers=0).
+# max_pending ограничивает число страниц в работе: если разбор или запись отстают, браузеры ждут.
+# Готовые результаты обрабатывает отдельный поток: колбэк future выполняется в служебном потоке пула процессов,
+# и блокирующая передача писателю или запрос к базе в нём задерживали бы получение остальных результатов.
+class ParseStage:
+    _STOP = object()
+
+    def __init__(self, workers, max_pending, writer):
+        self.writer = writer
+        self._executor = None
+        self._thread = None
+        if workers > 0:
+            # spawn: дочерние процессы не наследуют потоки драйверов и соединения с базой
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            # Без ограничения: число результатов в очереди и так не больше max_pending
+            self._results = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name="parse-results", daemon=True)
+            self._thread.start()
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+
+    def submit(self, payload, worker_id=None):
+        href = payload["href"]
+        if self._executor is None:
+            self._finish(href, worker_id, lambda: timed_parse_payload(payload))
+            return
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(timed_parse_payload, payload)
+        except Exception as e:
+            self._slots.release()
+            self._fail(href, e)
+            return
+        future.add_done_callback(lambda done: self._results.put((href, worker_id, done)))
+
+    def _run(self):
+        while True:
+            item = self._results.get()
+            if item is self._STOP:
+                return
+            href, worker_id, future = item
+            try:
+                self._finish(href, worker_id, future.result)
+            except Exception as e:
+                log_print(f"Ошибка обработки результата разбора {href}: {e}")
+            finally:
+                self._slots.release()
+
+    def _finish(self, href, worker_id, run):
+        try:
+            (data, reviews_list), wall_seconds, cpu_seconds = run()
+        except Exception as e:
+            self._fail(href, e)
+            return
+        metrics.observe_stage("parse", wall_seconds, cpu_seconds)
+        # Аренда продлевается на время очереди записи; перехваченное задание уже обходит другой воркер
+        if not keep_crawl_lease(href, worker_id):
+            return
+        metrics.inc("parser_reviews_total", len(reviews_list), help_text="Собрано новых отзывов")
+        # Очередь писателя ограничена: если база не успевает, этот вызов ждёт и сдерживает разбор
+        self.writer.submit(data, reviews_list)
+        log_print(f"Ссылка: {data['href']}\nНазвание: {data['name']}\nАдрес: {data['address']}\nТелефон: {data['phone']}\n"
+                  f"Рейтинг: {data['rate']}\nКол-во отзывов: {data['rate_count']}\nСайт: {data['site']}\n"
+                  f"Средний чек: {data['average_bill']}\nОтзывы: {len(reviews_list)} шт.\n---")
+        log_print(f"Заведение {href} обработано.")
+        metrics.inc("parser_venues_total", help_text="Обработано заведений", outcome="ok")
+
+    def _fail(self, href, error):
+        metrics.inc("parser_venues_total", help_text="Обработано заведений", outcome="error")
+        log_print(f"ERROR: Ошибка разбора {href}: {str(error)}")
+        try:
+            mark_crawl_failed(href, str(error))
+        except Exception as me:
+            log_print(f"Ошибка обновления состояния обхода: {me}")
+
+    def close(self):
+        if self._executor is not None:
+            # После shutdown все колбэки уже отработали, и стоп-метка встаёт в очередь последней
+            self._executor.shutdown(wait=True)
+            self._results.put(self._STOP)
+            self._thread.join()
+
+def wait_for_org_header(driver):
+    WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.CSS_SELECTOR, "h1.orgpage-header-view__header")))
+
+# Перезагрузка страницы заведения без блокировки ресурсов; возвращает, решена ли капча
+def reload_without_blocking(driver, url, reason):
+    resource_blocker.fall_back(driver, reason)
+    driver.get(url)
+    captcha_ok = solve_captcha(driver)
+    if not captcha_ok:
+        log_print(f"Не удалось решить капчу для {url} после перезагрузки.")
+    wait_for_org_header(driver)
+    return captcha_ok
+
+# Переход на вкладку 'Отзывы'. Возвращает (число отзывов на вкладке или None, число отрисованных отзывов)
+def open_reviews_tab(driver):
+    try:
+        log_print("Поиск вкладки 'Отзывы'...")
+        reviews_tab = WebDriverWait(driver, 10).until(
+            EC.element_to_be_clickable((By.CSS_SELECTOR, "a[href*='/reviews']"))
+        )
+        reported = parse_count(reviews_tab.text)
+        driver.execute_script("arguments[0].scrollIntoView(true);", reviews_tab)
+        driver.execute_script("arguments[0].click();", reviews_tab)
+        rendered = wait_for_nodes(driver, "div.business-review-view__body", 1, REVIEW_WAIT_TIMEOUT)
+        log_print("Переход на вкладку 'Отзывы' выполнен.")
+        return reported, rendered
+    except Exception as e:
+        log_print(f"Вкладка 'Отзывы' не найдена, продолжаем: {e}")
+        return None, 0
+
+# Этап браузера для одного заведения: страница, капча, прокрутка отзывов.
+# Драйвер возвращается в пул сразу после прокрутки, разбор и запись идут без него.
+def process_establishment(url, pool, parse_stage, worker_id=None):
+    try:
+        driver = pool.acquire()
+    except Exception as e:
+        metrics.inc("parser_venues_total", help_text="Обработано заведений", outcome="error")
+        log_print(f"ERROR: Нет драйвера для {url}: {str(e)}")
+        try:
+            mark_crawl_failed(url, str(e))
+        except Exception as me:
+            log_print(f"Ошибка обновления состояния обхода: {me}")
+        return
+    broken = False
+    payload = None
+    try:
+        log_print(f"Начало обработки заведения: {url}")
+        known_hashes = load_review_hashes(url)
+        pacer.pause()
+
+        capture = NetworkCapture(driver) if EXTRACTION_MODE == "network" else None
 
         log_print(f"Загрузка страницы {url}...")
-        driver.get(url)
+        with metrics.stage("driver_get"):
+            driver.get(url)
         log_print(f"Статус загрузки страницы: {driver.execute_script('return document.readyState')}")
-        if not solve_captcha(driver):
+        with metrics.stage("solve_captcha"):
+            captcha_ok = solve_captcha(driver)
+        if not captcha_ok:
             log_print(f"Не удалось решить капчу для {url}, продолжаем.")
+            broken = True
 
         log_print(f"Ожидание заголовка страницы {url}...")
-        WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.CSS_SELECTOR, "h1.orgpage-header-view__header")))
+        try:
+            wait_for_org_header(driver)
+        except TimeoutException:
+            # Заголовок не появился — возможно, страница зависит от заблокированного ресурса.
+            # При нерешённой капче заголовка нет по другой причине, и блокировку это не опровергает
+            if not captcha_ok or not resource_blocker.is_blocking(driver):
+                raise
+            captcha_ok = reload_without_blocking(driver, url, f"нет заголовка на {url}")
+            broken = not captcha_ok
         log_print(f"Страница {url} загружена.")
 
-        previous_review_count = 0
-        max_attempts = 100
-        attempts = 0
+        # Каждая попытка уже ждёт новых отзывов до REVIEW_WAIT_TIMEOUT, поэтому много попыток не нужно
+        max_attempts = int(os.getenv("REVIEW_SCROLL_ATTEMPTS", "5"))
         max_reviews = 200
 
-        try:
-            log_print("Поиск вкладки 'Отзывы'...")
-            reviews_tab = WebDriverWait(driver, 10).until(
-                EC.element_to_be_clickable((By.CSS_SELECTOR, "a[href*='/reviews']"))
-            )
-            driver.execute_script("arguments[0].scrollIntoView(true);", reviews_tab)
-            driver.execute_script("arguments[0].click();", reviews_tab)
-            time.sleep(random.uniform(1, 2))
-            log_print("Переход на вкладку 'Отзывы' выполнен.")
-        except Exception as e:
-            log_print(f"Вкладка 'Отзывы' не найдена, продолжаем: {e}")
-
-        while attempts < max_attempts and previous_review_count < max_reviews:
-            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            time.sleep(random.uniform(1, 3))
-            source = driver.page_source
-            soup = BeautifulSoup(source, 'html.parser')
-            reviews = soup.find_all('div', class_='business-review-view__body')
-            current_review_count = len(reviews)
-            if current_review_count > previous_review_count:
-                previous_review_count = current_review_count
-                attempts = 0
-            else:
-                attempts += 1
-            log_print(f"Найдено отзывов: {current_review_count}, попытка {attempts}/{max_attempts}")
-            if current_review_count >= max_reviews:
-                log_print(f"Достигнут лимит {max_reviews} отзывов для {url}.")
-                break
-        log_print(f"Прокрутка страницы {url} завершена, найдено {current_review_count} отзывов.")
-
-        data = {"href": url}
-        name = soup.find('h1', class_='orgpage-header-view__header')
-        data["name"] = name.text.strip() if name else "null"
-        address = soup.find('div', class_='business-contacts-view__address-link')
-        data["address"] = address.text.strip() if address else "null"
-        phone = soup.find('div', class_='orgpage-phones-view__phone-number')
-        data["phone"] = phone.text.strip() if phone else "null"
-        
-        rate_elements = soup.find_all('span', class_='business-summary-rating-badge-view__rating-text')
-        rate = ''.join([elem.text.strip() for elem in rate_elements if elem.text.strip() != ',']) if rate_elements else "null"
-        data["rate"] = rate.replace(',', '.') if rate != "null" else "null"
-        
-        rate_count = soup.find('span', class_='business-header-rating-view__text')
-        data["rate_count"] = rate_count.text.strip().split()[0] if rate_count and rate_count.text.strip() else "null"
-        site = soup.find('span', class_='business-urls-view__text')
-        data["site"] = site.text.strip() if site else "null"
-        average_bill = soup.find('span', class_='business-features-view__valued-value')
-        data["average_bill"] = average_bill.text.strip() if average_bill else "null"
-
-        establishment_id = save_establishment_to_db(data)
-
-        reviews_list = []
-        for review in soup.find_all('div', class_='business-review-view__body')[:max_reviews]:
-            review_text = review.find('span', class_='business-review-view__body-text')
-            author = review.find('span', class_='business-review-view__author')
-            rating = review.find('div', class_='business-rating-badge-view__stars')
-            rating_value = "N/A"
-            if rating:
-                stars = rating.find_all('span', class_='business-rating-badge-view__star _full')
-                rating_value = str(len(stars))
-            date = review.find('span', class_='business-review-view__date')
-            review_data = {
-                "text": review_text.text.strip() if review_text else "N/A",
-                "author": author.text.strip() if author else "N/A",
-                "rating": rating_value,
-                "date": date.text.strip() if date else "N/A"
-            }
-            reviews_list.append(review_data)
+        reported_reviews, rendered_reviews = open_reviews_tab(driver)
+        # Заголовок есть, а отзывы, о которых сообщает вкладка, не отрисовались: их лента тоже может зависеть
+        # от заблокированного ресурса. Случай засчитывается в max_fallbacks так же, как пропавший заголовок
+        if reported_reviews and not rendered_reviews and captcha_ok and resource_blocker.is_blocking(driver):
+            captcha_ok = reload_without_blocking(driver, url, f"нет отзывов на {url}")
+            broken = not captcha_ok
+            open_reviews_tab(driver)
 
-        if reviews_list:
-            save_reviews_to_db(establishment_id, reviews_list)
+        # При повторном обходе сортируем по новизне и останавливаемся на первом уже сохранённом отзыве
+        newest_first = bool(known_hashes) and sort_reviews_by_newest(driver)
 
-        log_print(f"Ссылка: {data['href']}\nНазвание: {data['name']}\nАдрес: {data['address']}\nТелефон: {data['phone']}\n"
-                  f"Рейтинг: {data['rate']}\nКол-во отзывов: {data['rate_count']}\nСайт: {data['site']}\n"
-                  f"Средний чек: {data['average_bill']}\nОтзывы: {len(reviews_list)} шт.\n---")
-        log_print(f"Заведение {index}/{total} обработано.")
+        with metrics.stage("scroll"):
+            dom_reviews, network_payloads = scroll_reviews(
+                driver, url, capture, known_hashes, newest_first, max_reviews, max_attempts
+            )
+        payload = {
+            "href": url,
+            "org_html": driver.execute_script(ORG_FRAGMENT_JS, ORG_FIELD_SELECTORS),
+            "dom_reviews": dom_reviews,
+            "network": network_payloads,
+            "known_hashes": known_hashes,
+            "max_reviews": max_reviews,
+        }
 
     except Exception as e:
+        broken = True
+        metrics.inc("parser_venues_total", help_text="Обработано заведений", outcome="error")
         log_print(f"ERROR: Ошибка при обработке {url}: {str(e)}")
-        with open("failed_urls.txt", "a") as f:
-            f.write(f"{url} - {str(e)}\n")
+        try:
+            mark_crawl_failed(url, str(e))
+        except Exception as me:
+            log_print(f"Ошибка обновления состояния обхода: {me}")
     finally:
-        if driver:
-            driver.quit()
-        time.sleep(random.uniform(2, 5))
+        pool.release(driver, broken=broken)
 
-# Основная функция
-def main():
-    # Проверка переменной окружения для переключения парсера
-    if os.getenv("ENABLE_PARSER", "false").lower() != "true":
-        log_print("Парсер выключен (ENABLE_PARSER=false). Завершение работы.")
-        return
+    if payload is not None and keep_crawl_lease(url, worker_id):
+        parse_stage.submit(payload, worker_id)
 
-    # Получение параметров из переменных окружения с значениями по умолчанию
-    title = os.getenv("TITLE", "кафе")
-    base_url = os.getenv("BASE_URL", "https://yandex.ru/maps/213/moscow/search/кафе")
-    count_of_units = 5000
-    max_scroll_time = 1800  # 30 минут на поиск
+# Цикл воркера: забирает задания из очереди, пока она не пустует дольше idle_exit секунд
+def run_queue_worker(pool, parse_stage, idle_exit):
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{threading.current_thread().name}"
+    idle_since = None
+    processed = 0
+    while True:
+        try:
+            href, budget_wait = claim_crawl_job(worker_id)
+        except Exception as e:
+            log_print(f"Ошибка получения задания из очереди: {e}")
+            href, budget_wait = None, 0.0
+        if budget_wait > 0:
+            # Бюджет исчерпан: это не простой очереди, ждём следующего токена
+            idle_since = None
+            metrics.inc("parser_budget_waits_total", help_text="Ожидания бюджета запросов")
+            time.sleep(min(budget_wait, 30) * random.uniform(1.0, 1.2))
+            continue
+        if href is None:
+            idle_since = idle_since or time.monotonic()
+            if time.monotonic() - idle_since >= idle_exit:
+                log_print(f"Воркер {worker_id}: очередь пуста, обработано {processed} заведений.")
+                return
+            time.sleep(5)
+            continue
+        idle_since = None
+        process_establishment(href, pool, parse_stage, worker_id)
+        processed += 1
+
+SNIPPET_WAIT_TIMEOUT = float(os.getenv("SNIPPET_WAIT_TIMEOUT", "8"))  # Сколько ждать новых сниппетов после прокрутки, сек
+
+# Селекторы сниппетов в выдаче: разметка Яндекса менялась, поэтому пробуем несколько
+POSSIBLE_SNIPPET_SELECTORS = [
+    ".search-business-snippet-view__title",
+    ".search-snippet-view__link-overlay",
+    ".business-snippet__link"
+]
+SNIPPET_SELECTORS = ", ".join(POSSIBLE_SNIPPET_SELECTORS)
+
+# Возвращает ссылки всех сниппетов, сейчас находящихся в DOM
+HARVEST_LINKS_JS = """
+const nodes = document.querySelectorAll(arguments[0]);
+const links = [];
+for (const node of nodes) {
+    let anchor = node.tagName === 'A' ? node : null;
+    if (!anchor) {
+        const card = node.closest('.search-snippet-view, .search-business-snippet-view') || node.parentElement;
+        anchor = card && (card.querySelector('a[href*="/org/"]') || card.querySelector('a[href]'));
+    }
+    if (anchor && anchor.href) links.push(anchor.href);
+}
+return links;
+"""
+
+# Ссылка на организацию: .../org/<slug>/<id>/
+ORG_HREF_RE = re.compile(r"/org/(?:[^/?#]+/)?(\d+)")
+
+def org_id(href):
+    match = ORG_HREF_RE.search(href)
+    return match.group(1) if match else None
+
+# Ссылка без параметров и вкладок после id организации; одна организация — одна ссылка
+def canonical_org_href(href):
+    href = href.strip()
+    match = ORG_HREF_RE.search(href)
+    return href[:match.end()] + "/" if match else href
 
-    log_print(f"Запуск парсера для {title} по ссылке {base_url}")
+# Деление прямоугольника (lon_min, lat_min, lon_max, lat_max) на grid x grid тайлов
+def split_bbox(bbox, grid):
+    lon_min, lat_min, lon_max, lat_max = bbox
+    lon_step = (lon_max - lon_min) / grid
+    lat_step = (lat_max - lat_min) / grid
+    return [
+        (lon_min + i * lon_step, lat_min + j * lat_step, lon_min + (i + 1) * lon_step, lat_min + (j + 1) * lat_step)
+        for i in range(grid)
+        for j in range(grid)
+    ]
 
+# URL поиска, ограниченный областью тайла через параметры ll/spn/z
+def tile_url(base_url, tile):
+    lon_min, lat_min, lon_max, lat_max = tile
+    lon_span = lon_max - lon_min
+    lat_span = lat_max - lat_min
+    # Масштаб, при котором долготный охват помещается в окно шириной 1920 px (тайлы карты по 256 px)
+    zoom = max(3, min(19, int(math.log2(1920 * 360 / (256 * lon_span)))))
+    parts = urlsplit(base_url)
+    query = dict(parse_qsl(parts.query))
+    query.update({
+        "ll": f"{(lon_min + lon_max) / 2:.6f},{(lat_min + lat_max) / 2:.6f}",
+        "spn": f"{lon_span:.6f},{lat_span:.6f}",
+        "z": str(zoom),
+    })
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query, safe=","), parts.fragment))
+
+# Сбор ссылок по тайлам города в несколько браузеров; плотные тайлы делятся на четыре.
+# Ссылки объединяются по id организации; on_links получает новые ссылки каждой итерации прокрутки любого тайла.
+def collect_links_tiled(base_url, bbox, grid, workers, max_depth, saturation, count_of_units, tile_scroll_time, on_links=None):
+    links = {}
+    tiles_done = 0
+    # cancel() снимает только не начатые тайлы; уже прокручивающиеся останавливаются по этому событию
+    stop_event = threading.Event()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tile") as executor:
+        pending = {
+            executor.submit(
+                collect_establishment_links, tile_url(base_url, tile), count_of_units, tile_scroll_time, on_links, stop_event
+            ): (tile, 0)
+            for tile in split_bbox(bbox, grid)
+        }
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                tile, depth = pending.pop(future)
+                tiles_done += 1
+                try:
+                    tile_links = future.result()
+                except Exception as e:
+                    log_print(f"Ошибка сбора ссылок тайла {tile}: {e}")
+                    tile_links = None
+                if tile_links is None:
+                    log_print(f"Тайл {tile} пропущен.")
+                    continue
+                before = len(links)
+                for href in tile_links:
+                    links.setdefault(org_id(href) or href, href)
+                log_print(f"Тайл {tile} (глубина {depth}): {len(tile_links)} ссылок, новых {len(links) - before}, всего {len(links)}.")
+                if len(links) >= count_of_units:
+                    continue
+                # Выдача упёрлась в потолок боковой панели: дробим тайл, чтобы добрать скрытые заведения
+                if len(tile_links) >= saturation and depth < max_depth:
+                    log_print(f"Тайл {tile} насыщен, делим на 4.")
+                    for sub_tile in split_bbox(tile, 2):
+                        sub_future = executor.submit(
+                            collect_establishment_links, tile_url(base_url, sub_tile), count_of_units, tile_scroll_time, on_links,
+                            stop_event,
+                        )
+                        pending[sub_future] = (sub_tile, depth + 1)
+            if len(links) >= count_of_units:
+                stop_event.set()
+                for future in pending:
+                    future.cancel()
+                break
+    log_print(f"Сбор по тайлам завершён: обработано тайлов {tiles_done}, уникальных ссылок {len(links)}.")
+    return set(list(links.values())[:count_of_units])
+
+# Функция сбора ссылок на заведения со страницы поиска; on_links вызывается с новыми ссылками каждой итерации.
+# stop_event прерывает прокрутку, когда общий лимит ссылок уже набран другими тайлами
+def collect_establishment_links(base_url, count_of_units, max_scroll_time, on_links=None, stop_event=None):
     driver = None
     href_list = set()
+    if stop_event is not None and stop_event.is_set():
+        return href_list
 
     try:
         driver = create_driver()
@@ -339,18 +2233,25 @@ def main():
                 break
             except Exception as e:
                 log_print(f"Ошибка загрузки {base_url} на попытке {attempt}: {str(e)}")
+                metrics.inc("parser_retries_total", help_text="Повторные загрузки страниц", stage="search_page")
                 if attempt == 3:
                     log_print(f"Не удалось загрузить {base_url} после 3 попыток.")
                     break
-                time.sleep(random.uniform(5, 10))
+                pacer.pause()
 
         if not solve_captcha(driver):
             log_print(f"Не удалось решить капчу для {base_url}.")
             with open(f"error_page_{int(time.time())}.html", "w", encoding="utf-8") as f:
                 f.write(driver.page_source)
-            return
+            return None
 
-        time.sleep(random.uniform(10, 20))
+        # Проверка, что сниппеты отрисовываются при заблокированных ресурсах
+        if resource_blocker.is_blocking(driver) and not wait_for_nodes(driver, SNIPPET_SELECTORS, 1, SNIPPET_WAIT_TIMEOUT * 2):
+            resource_blocker.fall_back(driver, f"нет сниппетов на {base_url}")
+            driver.get(base_url)
+            if not solve_captcha(driver):
+                log_print(f"Не удалось решить капчу для {base_url} после перезагрузки.")
+                return None
 
         wait = WebDriverWait(driver, 300)
         try:
@@ -366,16 +2267,11 @@ def main():
 
             for _ in range(3):
                 driver.execute_script("window.scrollBy(0, 500);")
-                time.sleep(random.uniform(2, 5))
+                wait_for_dom_idle(driver)
 
             max_attempts = 3
             for attempt in range(max_attempts):
-                possible_selectors = [
-                    ".search-business-snippet-view__title",
-                    ".search-snippet-view__link-overlay",
-                    ".business-snippet__link"
-                ]
-                for selector in possible_selectors:
+                for selector in POSSIBLE_SNIPPET_SELECTORS:
                     try:
                         elements = wait.until(
                             EC.visibility_of_all_elements_located((By.CSS_SELECTOR, selector))
@@ -402,76 +2298,173 @@ def main():
                 log_print(f"Скриншот сохранён: error_screenshot_{int(time.time())}.png")
             except Exception as se:
                 log_print(f"Ошибка сохранения скриншота: {se}")
-            return
+            return None
 
+        # Ссылки собираются на каждой итерации прокрутки одним JS-вызовом, поэтому
+        # сниппеты, которые список уже убрал из DOM (виртуализация), не теряются
         n = 0
         start_time = time.time()
-        while len(elements) < count_of_units and time.time() - start_time < max_scroll_time:
-            if not solve_captcha(driver):
+        while len(href_list) < count_of_units and time.time() - start_time < max_scroll_time:
+            if stop_event is not None and stop_event.is_set():
+                log_print(f"Прокрутка {base_url} остановлена: лимит ссылок набран.")
+                break
+            if not solve_captcha(driver, navigation=False):
                 log_print(f"Не удалось решить капчу во время прокрутки, продолжаем.")
 
-            time.sleep(random.uniform(2, 5))
-            elements_before = len(elements)
+            pacer.pause(fraction=0.5)
+            links_before = len(href_list)
 
             try:
-                log_print(f"Текущая высота страницы: {driver.execute_script('return document.body.scrollHeight')}")
-                elements = driver.find_elements(By.CSS_SELECTOR, selector)
-                if elements:
-                    last_element = elements[-1]
-                    driver.execute_script("arguments[0].scrollIntoView(true);", last_element)
-                    time.sleep(random.uniform(0.5, 1.0))
+                harvested = driver.execute_script(HARVEST_LINKS_JS, selector)
+                new_links = {canonical_org_href(href) for href in harvested if href and href.strip()} - href_list
+                href_list.update(new_links)
+                if on_links and new_links:
+                    on_links(new_links)
+                # Прокручиваем к последнему сниппету и ждём появления новых вместо фиксированной паузы
+                wait_for_added_nodes(driver, selector, SNIPPET_WAIT_TIMEOUT, scroll_to_last=True)
             except Exception as e:
-                log_print(f"Ошибка при ожидании элементов: {e}")
+                log_print(f"Ошибка при сборе ссылок: {e}")
                 n += 1
                 if n >= 10:
                     log_print(f"Скроллинг завершён из-за отсутствия новых элементов или ошибок.")
                     break
                 continue
 
-            elements_after = len(driver.find_elements(By.CSS_SELECTOR, selector))
-            log_print(f"Найдено элементов: {elements_after} после прокрутки")
+            log_print(f"Собрано уникальных ссылок: {len(href_list)} (видимых сниппетов: {len(harvested)})")
 
-            if elements_before == elements_after:
+            if len(href_list) == links_before:
                 n += 1
-                log_print(f"Нет новых элементов, итерация {n}")
+                log_print(f"Нет новых ссылок, итерация {n}")
                 if n >= 10:
                     log_print(f"Скроллинг завершён из-за отсутствия новых элементов.")
                     break
             else:
                 n = 0
-                log_print("Найдены новые элементы.")
+                log_print("Найдены новые ссылки.")
 
-        for idx, title in enumerate(driver.find_elements(By.CSS_SELECTOR, ".search-business-snippet-view__title")):
-            try:
-                parent = title.find_element(By.XPATH, "./ancestor::div[contains(@class, 'search-business-snippet-view')]//a")
-                href = parent.get_attribute('href')
-                if href and href.strip():
-                    href_list.add(href)
-                    log_print(f"Ссылка {idx + 1} собрана: {href}")
-                else:
-                    log_print(f"Пропущен элемент без валидной ссылки (индекс {idx + 1})")
-            except Exception as e:
-                log_print(f"Не удалось собрать ссылку для элемента {idx + 1}: {e}")
-                continue
+        # Последняя порция, подгруженная после финальной прокрутки
+        try:
+            new_links = {
+                canonical_org_href(href) for href in driver.execute_script(HARVEST_LINKS_JS, selector) if href and href.strip()
+            } - href_list
+            href_list.update(new_links)
+            if on_links and new_links:
+                on_links(new_links)
+        except Exception as e:
+            log_print(f"Ошибка при сборе ссылок: {e}")
 
         log_print(f"Итоговое количество уникальных ссылок: {len(href_list)}")
 
-        href_list = list(href_list)[:count_of_units]
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            for index, href in enumerate(href_list, 1):
-                log_print(f"Запуск обработки ссылки {index}: {href}")
-                executor.submit(process_establishment, href, index, len(href_list))
+        return href_list
 
     except Exception as e:
-        log_print(f"Ошибка: {e}")
+        log_print(f"Ошибка сбора ссылок: {e}")
         log_print("Полный стек-трейс:")
         log_print(traceback.format_exc())
         if driver:
             with open(f"error_page_main_{int(time.time())}.html", "w", encoding="utf-8") as f:
                 f.write(driver.page_source)
+        return None
     finally:
         if driver:
             driver.quit()
+
+# Основная функция
+def main():
+    # Проверка переменной окружения для переключения парсера
+    if os.getenv("ENABLE_PARSER", "false").lower() != "true":
+        log_print("Парсер выключен (ENABLE_PARSER=false). Завершение работы.")
+        return
+
+    # Получение параметров из переменных окружения с значениями по умолчанию
+    title = os.getenv("TITLE", "кафе")
+    base_url = os.getenv("BASE_URL", "https://yandex.ru/maps/213/moscow/search/кафе")
+    count_of_units = int(os.getenv("COUNT_OF_UNITS", "5000"))  # Сколько ссылок собрать
+    max_scroll_time = int(os.getenv("MAX_SCROLL_TIME", "1800"))  # 30 минут на поиск
+    max_workers = int(os.getenv("MAX_WORKERS", "5"))  # Браузеров (потоков этапа браузера)
+    parse_workers = int(os.getenv("PARSE_WORKERS", "2"))  # Процессов разбора; 0 — разбор в потоке браузера
+    parse_max_pending = int(os.getenv("PARSE_MAX_PENDING", str(max_workers * 2)))  # Страниц, ожидающих разбора
+    driver_max_pages = int(os.getenv("DRIVER_MAX_PAGES", "50"))  # Страниц на один драйвер до перезапуска
+    db_batch_size = int(os.getenv("DB_BATCH_SIZE", "20"))  # Заведений в одной записи в базу
+    db_flush_interval = float(os.getenv("DB_FLUSH_INTERVAL", "10"))  # Максимальная задержка записи, сек
+    freshness_hours = float(os.getenv("CRAWL_FRESHNESS_HOURS", "24"))  # Не обходить заново заведения, обработанные за это время
+
+    crawl_role = os.getenv("CRAWL_ROLE", "all").lower()  # all, collector или worker
+    # Сбор ссылок по тайлам карты: область города делится на прямоугольники, каждый прокручивается своим браузером
+    tiling = os.getenv("TILING", "false").lower() == "true"
+    city_bbox = tuple(float(value) for value in os.getenv("CITY_BBOX", "37.32,55.55,37.95,55.92").split(","))  # lon_min,lat_min,lon_max,lat_max
+    tile_grid = int(os.getenv("TILE_GRID", "3"))  # Начальная сетка TILE_GRID x TILE_GRID
+    tile_workers = int(os.getenv("TILE_WORKERS", "3"))  # Браузеров, прокручивающих тайлы параллельно
+    tile_max_depth = int(os.getenv("TILE_MAX_DEPTH", "2"))  # Сколько раз можно делить плотный тайл
+    tile_saturation = int(os.getenv("TILE_SATURATION", "400"))  # Столько ссылок в тайле — признак потолка выдачи
+    tile_scroll_time = int(os.getenv("TILE_MAX_SCROLL_TIME", "600"))  # Время прокрутки одного тайла, сек
+    queue_idle_exit = float(os.getenv("QUEUE_IDLE_EXIT", "60"))  # Воркер завершается после стольких секунд пустой очереди
+    metrics_port = int(os.getenv("METRICS_PORT", "8000"))  # 0 — не поднимать HTTP-эндпоинт метрик
+    metrics_summary_path = os.getenv("METRICS_SUMMARY_PATH", f"metrics_summary_{int(time.time())}.json")
+
+    metrics.REGISTRY.gauge("parser_queue_depth", "Заданий в очереди, готовых к обработке").set_function(count_queued_jobs)
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+        log_print(f"Метрики доступны на порту {metrics_port}: /metrics и /metrics.json")
+
+    log_print(f"Запуск парсера ({crawl_role}) для {title} по ссылке {base_url}")
+
+    try:
+        if crawl_role in ("all", "collector"):
+            # Незавершённые задания прошлого запуска обрабатываем без повторного сбора ссылок
+            unfinished = has_unfinished_jobs(base_url)
+            if unfinished:
+                log_print(f"Продолжение прерванного обхода: в очереди {unfinished} ещё не обработанных ссылок.")
+            else:
+                registrar = LinkRegistrar(base_url, title, freshness_hours, count_of_units)
+                with metrics.stage("link_collection"):
+                    if tiling:
+                        collected = collect_links_tiled(
+                            base_url, city_bbox, tile_grid, tile_workers, tile_max_depth,
+                            tile_saturation, count_of_units, tile_scroll_time, on_links=registrar.add
+                        )
+                    else:
+                        collected = collect_establishment_links(base_url, count_of_units, max_scroll_time, on_links=registrar.add)
+                # Сбор мог оборваться ошибкой, но уже поставленные ссылки всё равно обрабатываем
+                registrar.add(collected or ())
+                registrar.flush()
+                if collected is None and not registrar.count:
+                    return
+                log_print(f"Сбор завершён: передано {registrar.count} ссылок, обработанные за последние {freshness_hours} ч в очередь не встают.")
+
+        if crawl_role in ("all", "worker"):
+            # Конвейер: браузеры -> пул процессов разбора -> один писатель в базу, между этапами ограниченные очереди
+            writer = BatchWriter(batch_size=db_batch_size, flush_interval=db_flush_interval)
+            parse_stage = ParseStage(workers=parse_workers, max_pending=parse_max_pending, writer=writer)
+            pool = DriverPool(
+                size=max_workers, max_pages=driver_max_pages,
+                spawn_attempts=int(os.getenv("DRIVER_SPAWN_ATTEMPTS", "3")),  # Попыток запуска драйвера подряд
+                acquire_timeout=float(os.getenv("DRIVER_ACQUIRE_TIMEOUT", "300")),  # Сколько ждать свободный драйвер, сек
+            )
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    for _ in range(max_workers):
+                        executor.submit(run_queue_worker, pool, parse_stage, queue_idle_exit)
+            finally:
+                pool.close()
+                parse_stage.close()
+                writer.close()
+
+    except Exception as e:
+        log_print(f"Ошибка: {e}")
+        log_print("Полный стек-трейс:")
+        log_print(traceback.format_exc())
+    finally:
+        try:
+            reviews_total = metrics.REGISTRY.counter("parser_reviews_total").value
+            uptime = time.time() - metrics.REGISTRY.started_at
+            summary = metrics.write_summary(metrics_summary_path, {
+                "reviews_per_second": round(reviews_total / uptime, 4) if uptime else None,
+            })
+            log_print(f"Сводка метрик сохранена в {metrics_summary_path}: {json.dumps(summary, ensure_ascii=False)}")
+        except Exception as e:
+            log_print(f"Ошибка сохранения сводки метрик: {e}")
+        close_db_pool()
         log_print("Завершение работы скрипта.")
 
 if __name__ == "__main__":
@@ -0,0 +1,216 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограмм, в секундах
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Приведение меток к строке формата Prometheus: {stage="scroll"}
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+class Counter:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+class Gauge:
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    # Значение вычисляется при каждом чтении, например глубина очереди из базы
+    def set_function(self, function):
+        self._function = function
+
+    @property
+    def value(self):
+        if self._function is not None:
+            try:
+                return float(self._function())
+            except Exception:
+                return float("nan")
+        return self._value
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._sum += value
+            self._count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum, self._count
+
+    # Оценка квантиля по границам корзин: верхняя граница корзины, в которую попал квантиль
+    def quantile(self, q):
+        counts, _, count = self.snapshot()
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+# Реестр метрик: имя + набор меток -> метрика
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def _get(self, kind, name, help_text, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = kind()
+                self._metrics[key] = metric
+                self._help.setdefault(name, (kind.__name__.lower(), help_text))
+            return metric
+
+    def counter(self, name, help_text="", **labels):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", **labels):
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text="", **labels):
+        return self._get(Histogram, name, help_text, labels)
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._metrics.items(), key=lambda item: item[0])
+
+    # Текстовый формат Prometheus
+    def render_prometheus(self):
+        lines = []
+        described = set()
+        for (name, labels), metric in self._items():
+            if name not in described:
+                kind, help_text = self._help[name]
+                if help_text:
+                    lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+            if isinstance(metric, Histogram):
+                counts, total, count = metric.snapshot()
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    # Сводка для JSON: счётчики, датчики и среднее/сумма по гистограммам
+    def summary(self):
+        result = {"uptime_seconds": round(time.time() - self.started_at, 3), "metrics": {}}
+        for (name, labels), metric in self._items():
+            key = name + _format_labels(labels)
+            if isinstance(metric, Histogram):
+                _, total, count = metric.snapshot()
+                p95 = metric.quantile(0.95)
+                result["metrics"][key] = {
+                    "count": count,
+                    "sum": round(total, 6),
+                    "avg": round(total / count, 6) if count else None,
+                    "p95": p95 if p95 != float("inf") else None,
+                }
+            else:
+                value = metric.value
+                result["metrics"][key] = None if value != value else value
+        return result
+
+REGISTRY = Registry()
+
+# Запись замера этапа; используется и для этапов, выполненных в других процессах
+def observe_stage(name, wall_seconds, cpu_seconds):
+    REGISTRY.histogram("parser_stage_wall_seconds", "Настенное время этапа на одно заведение", stage=name).observe(wall_seconds)
+    REGISTRY.histogram("parser_stage_cpu_seconds", "Процессорное время потока на этап", stage=name).observe(cpu_seconds)
+
+# Замер этапа обработки: настенное время и процессорное время потока
+@contextmanager
+def stage(name):
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+def inc(name, amount=1, help_text="", **labels):
+    REGISTRY.counter(name, help_text, **labels).inc(amount)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body = json.dumps(REGISTRY.summary(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        elif self.path.startswith("/metrics"):
+            body = REGISTRY.render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# HTTP-эндпоинт /metrics (Prometheus) и /metrics.json в фоновом потоке
+def start_http_server(port, host="0.0.0.0"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return server
+
+# Запись итоговой сводки в файл при завершении работы
+def write_summary(path, extra=None):
+    summary = REGISTRY.summary()
+    if extra:
+        summary.update(extra)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
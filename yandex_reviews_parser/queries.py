@@ -0,0 +1,134 @@
+from psycopg2.extras import RealDictCursor
+
+from main import db_connection
+
+# Запросы для дашборда поверх поискового индекса отзывов и агрегатов по заведениям.
+# Все функции возвращают списки словарей; поиск идёт по GIN-индексу reviews.search_vector,
+# средние и гистограммы читаются из establishment_review_stats и review_daily_stats без сканирования reviews.
+
+TEXT_SEARCH_CONFIG = "russian"
+
+# Допустимые сортировки: имя параметра -> выражение ORDER BY
+VENUE_ORDERS = {
+    "avg_rating": "s.avg_rating DESC NULLS LAST, s.review_count DESC",
+    "worst": "s.avg_rating ASC NULLS LAST, s.review_count DESC",
+    "review_count": "s.review_count DESC",
+    "latest": "s.latest_review_date DESC NULLS LAST",
+}
+
+def _fetch(sql, params):
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(sql, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+# Общие фильтры по оценке, заведению и типу заведения из обхода (crawl_state.title)
+def _review_filters(min_rating, max_rating, establishment_id, title, since):
+    conditions, params = [], {}
+    if min_rating is not None:
+        conditions.append("r.rating >= %(min_rating)s")
+        params["min_rating"] = min_rating
+    if max_rating is not None:
+        conditions.append("r.rating <= %(max_rating)s")
+        params["max_rating"] = max_rating
+    if establishment_id is not None:
+        conditions.append("r.establishment_id = %(establishment_id)s")
+        params["establishment_id"] = establishment_id
+    if title is not None:
+        conditions.append("EXISTS (SELECT 1 FROM crawl_state cs WHERE cs.href = e.href AND cs.title = %(title)s)")
+        params["title"] = title
+    if since is not None:
+        conditions.append("r.date >= %(since)s")
+        params["since"] = since
+    return conditions, params
+
+# Поиск отзывов по словам в синтаксисе веб-поиска: «кофе -десерт», «"очень долго"»
+def search_reviews(text, min_rating=None, max_rating=None, establishment_id=None, title=None, since=None, limit=50):
+    conditions, params = _review_filters(min_rating, max_rating, establishment_id, title, since)
+    params.update({"config": TEXT_SEARCH_CONFIG, "text": text, "limit": limit})
+    where = " AND ".join(["r.search_vector @@ websearch_to_tsquery(%(config)s, %(text)s)"] + conditions)
+    # Подсветка считается только для строк, попавших в LIMIT
+    return _fetch(f"""
+        SELECT found.*, ts_headline(%(config)s, found.review_text, websearch_to_tsquery(%(config)s, %(text)s)) AS headline
+        FROM (
+            SELECT r.id, r.establishment_id, e.name AS establishment_name, r.author, r.rating, r.date, r.review_text
+            FROM reviews r
+            JOIN establishment_data e ON e.id = r.establishment_id
+            WHERE {where}
+            ORDER BY r.date DESC NULLS LAST, r.id DESC
+            LIMIT %(limit)s
+        ) found
+        ORDER BY found.date DESC NULLS LAST, found.id DESC
+    """, params)
+
+# Заведения, в отзывах которых упоминается запрос: «кафе, где пишут про кофе с оценкой не выше 2»
+def venues_mentioning(text, min_rating=None, max_rating=None, title=None, since=None, limit=50):
+    conditions, params = _review_filters(min_rating, max_rating, None, title, since)
+    params.update({"config": TEXT_SEARCH_CONFIG, "text": text, "limit": limit})
+    where = " AND ".join(["r.search_vector @@ websearch_to_tsquery(%(config)s, %(text)s)"] + conditions)
+    return _fetch(f"""
+        SELECT e.id AS establishment_id, e.name, e.address, count(*) AS matching_reviews,
+               avg(r.rating)::float8 AS matching_avg_rating, max(r.date) AS latest_match
+        FROM reviews r
+        JOIN establishment_data e ON e.id = r.establishment_id
+        WHERE {where}
+        GROUP BY e.id, e.name, e.address
+        ORDER BY matching_reviews DESC, latest_match DESC NULLS LAST
+        LIMIT %(limit)s
+    """, params)
+
+# Сводка по заведениям за всё время: число отзывов, средняя оценка, гистограмма 1..5, дата последнего отзыва
+def venue_stats(establishment_ids=None, title=None, min_reviews=1, order_by="avg_rating", limit=100):
+    if order_by not in VENUE_ORDERS:
+        raise ValueError(f"Неизвестная сортировка: {order_by}, допустимы {', '.join(VENUE_ORDERS)}")
+    conditions = ["s.review_count >= %(min_reviews)s"]
+    params = {"min_reviews": min_reviews, "limit": limit}
+    if establishment_ids is not None:
+        conditions.append("s.establishment_id = ANY(%(ids)s)")
+        params["ids"] = list(establishment_ids)
+    if title is not None:
+        conditions.append("EXISTS (SELECT 1 FROM crawl_state cs WHERE cs.href = e.href AND cs.title = %(title)s)")
+        params["title"] = title
+    return _fetch(f"""
+        SELECT s.establishment_id, e.name, e.address, e.rate AS yandex_rate, s.review_count, s.avg_rating,
+               ARRAY[s.rating_1, s.rating_2, s.rating_3, s.rating_4, s.rating_5] AS rating_histogram,
+               s.latest_review_date
+        FROM establishment_review_stats s
+        JOIN establishment_data e ON e.id = s.establishment_id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY {VENUE_ORDERS[order_by]}
+        LIMIT %(limit)s
+    """, params)
+
+# Средняя оценка по заведениям за последние days дней по дневным агрегатам
+def rating_window(days=90, establishment_ids=None, min_reviews=1, limit=100):
+    conditions = ["d.day >= current_date - %(days)s"]
+    params = {"days": days, "min_reviews": min_reviews, "limit": limit}
+    if establishment_ids is not None:
+        conditions.append("d.establishment_id = ANY(%(ids)s)")
+        params["ids"] = list(establishment_ids)
+    return _fetch(f"""
+        SELECT d.establishment_id, e.name, sum(d.review_count) AS review_count,
+               sum(d.rating_sum)::float8 / NULLIF(sum(d.rating_count), 0) AS avg_rating,
+               ARRAY[sum(d.rating_1), sum(d.rating_2), sum(d.rating_3), sum(d.rating_4), sum(d.rating_5)] AS rating_histogram
+        FROM review_daily_stats d
+        JOIN establishment_data e ON e.id = d.establishment_id
+        WHERE {" AND ".join(conditions)}
+        GROUP BY d.establishment_id, e.name
+        HAVING sum(d.review_count) >= %(min_reviews)s
+        ORDER BY avg_rating DESC NULLS LAST, review_count DESC
+        LIMIT %(limit)s
+    """, params)
+
+# Динамика оценки одного заведения по неделям или месяцам для графика
+def rating_trend(establishment_id, days=365, bucket="month"):
+    if bucket not in ("day", "week", "month"):
+        raise ValueError(f"Неизвестный интервал: {bucket}")
+    return _fetch("""
+        SELECT date_trunc(%(bucket)s, d.day)::date AS period, sum(d.review_count) AS review_count,
+               sum(d.rating_sum)::float8 / NULLIF(sum(d.rating_count), 0) AS avg_rating
+        FROM review_daily_stats d
+        WHERE d.establishment_id = %(establishment_id)s AND d.day >= current_date - %(days)s
+        GROUP BY period
+        ORDER BY period
+    """, {"establishment_id": establishment_id, "days": days, "bucket": bucket})
@@ -0,0 +1,245 @@
+import argparse
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+from main import close_db_pool, db_connection, db_params, get_job_watermark, log_print, set_job_watermark, setup_database
+
+# Офлайн-оценка тональности отзывов: словарь русских основ, расчёт по пачке в NumPy, без сетевых вызовов.
+# Новые строки читаются после отметки в job_watermarks, суммы по заведениям наращиваются, а не пересчитываются.
+
+JOB_NAME = "sentiment"
+MODEL_VERSION = "lexicon-v1"
+SENTIMENT_LOCK_KEY = 7_161_016  # Ключ pg_advisory_lock: одновременно работает только один запуск
+
+SENTIMENT_CHUNK_SIZE = int(os.getenv("SENTIMENT_CHUNK_SIZE", "5000"))  # Отзывов в одной пачке чтения и записи
+SENTIMENT_WORKERS = int(os.getenv("SENTIMENT_WORKERS", "2"))  # Процессов оценки; 0 — оценка в основном процессе
+SENTIMENT_LOOKBACK_IDS = int(os.getenv("SENTIMENT_LOOKBACK_IDS", "10000"))  # Насколько ниже отметки перепроверять id
+SENTIMENT_THRESHOLD = float(os.getenv("SENTIMENT_THRESHOLD", "0.2"))  # |score| не меньше порога — positive/negative
+
+# Основа слова -> вес. Сравнение по самому длинному совпавшему префиксу, поэтому «недорог» важнее «дорог»
+LEXICON = {
+    # Положительные
+    "отлич": 2.0, "прекрас": 2.0, "замечат": 2.0, "великолеп": 2.0, "восхит": 2.0, "потряс": 2.0,
+    "шикар": 2.0, "идеальн": 2.0, "обожа": 2.0, "лучш": 1.5, "вкусн": 1.5, "рекоменд": 1.5, "совету": 1.5,
+    "супер": 1.5, "класс": 1.5, "любим": 1.0, "люблю": 1.5, "хорош": 1.0, "уютн": 1.0, "приятн": 1.0,
+    "вежлив": 1.0, "любезн": 1.0, "внимател": 1.0, "дружелюб": 1.0, "доброжел": 1.0, "понрав": 1.0,
+    "нрав": 1.0, "доволь": 1.0, "довол": 1.0, "спасиб": 1.0, "благодар": 1.0, "вернус": 1.0,
+    "вернемс": 1.0, "молодц": 1.0, "профессионал": 1.0, "комфорт": 1.0, "красив": 1.0, "радует": 1.0,
+    "удобн": 0.5, "чист": 0.5, "быстр": 0.5, "свеж": 0.5, "недорог": 0.5, "доступн": 0.5, "аккуратн": 0.5,
+    "неплох": 0.5,
+    # Отрицательные
+    "ужас": -2.0, "кошмар": -2.0, "отврат": -2.0, "мерзк": -2.0, "хамст": -2.0, "хамил": -2.0,
+    "хамк": -2.0, "тухл": -2.0, "обман": -2.0, "обсчит": -2.0, "худш": -2.0, "отравл": -2.0,
+    "таракан": -2.0, "разочаров": -1.5, "недоволь": -1.5, "недовол": -1.5, "плох": -1.5, "невкусн": -1.5,
+    "безвкус": -1.5, "груб": -1.5, "грязн": -1.5, "грязь": -1.5, "испорч": -1.5, "несвеж": -1.5,
+    "хуже": -1.5, "противн": -1.5, "неприятн": -1.5, "невежлив": -1.5, "непрофессионал": -1.5,
+    "гадк": -1.5, "медлен": -1.0, "пересол": -1.0, "пережар": -1.0, "сыров": -1.0, "жалоб": -1.0,
+    "проблем": -1.0, "забыл": -1.0, "ошиб": -1.0, "скучн": -1.0, "душн": -1.0, "неудоб": -1.0,
+    "переплат": -1.0, "долго": -0.5, "дорог": -0.5, "дорож": -0.5, "холодн": -0.5, "шумн": -0.5,
+    "тесн": -0.5, "жаль": -0.5,
+}
+NEGATORS = frozenset(("не", "нет", "ни", "без", "никогда"))
+INTENSIFIERS = frozenset(("очень", "оч", "весьма", "крайне", "слишком", "совсем", "абсолютно", "невероятно", "самый", "самая", "самое"))
+NEGATION_WINDOW = 2  # Отрицание действует на два следующих слова: «не очень вкусно»
+INTENSIFIER_WEIGHT = 1.5
+
+STEM_LENGTHS = sorted({len(stem) for stem in LEXICON}, reverse=True)
+TOKEN_RE = re.compile(r"[а-яa-z]+")
+
+# Вес слова и его роль: 0 — обычное, 1 — отрицание, 2 — усилитель. Словарь отзывов повторяется, поэтому кэш
+@lru_cache(maxsize=200_000)
+def classify_token(token):
+    if token in NEGATORS:
+        return 0.0, 1
+    if token in INTENSIFIERS:
+        return 0.0, 2
+    for length in STEM_LENGTHS:
+        if length <= len(token):
+            weight = LEXICON.get(token[:length])
+            if weight is not None:
+                return weight, 0
+    return 0.0, 0
+
+# Функция оценки пачки текстов: все слова пачки в одном массиве, суммы по отзывам через np.bincount.
+# score = tanh(сумма весов / sqrt(число оценочных слов)) в диапазоне (-1, 1)
+def score_texts(texts):
+    count = len(texts)
+    doc_index = []
+    weights = []
+    roles = []
+    for i, text in enumerate(texts):
+        if not text or text == "N/A":
+            continue
+        for token in TOKEN_RE.findall(text.lower().replace("ё", "е")):
+            weight, role = classify_token(token)
+            doc_index.append(i)
+            weights.append(weight)
+            roles.append(role)
+    if not weights:
+        return np.zeros(count, dtype=np.float32)
+
+    doc_index = np.asarray(doc_index, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+    roles = np.asarray(roles, dtype=np.int8)
+
+    # Отрицание и усилитель в пределах окна перед словом и внутри того же отзыва
+    negated = np.zeros(len(weights), dtype=bool)
+    intensified = np.zeros(len(weights), dtype=bool)
+    for shift in range(1, NEGATION_WINDOW + 1):
+        same_doc = doc_index[shift:] == doc_index[:-shift]
+        negated[shift:] |= (roles[:-shift] == 1) & same_doc
+        intensified[shift:] |= (roles[:-shift] == 2) & same_doc
+    contributions = weights * np.where(negated, -1.0, 1.0) * np.where(intensified, INTENSIFIER_WEIGHT, 1.0)
+
+    sums = np.bincount(doc_index, weights=contributions, minlength=count)
+    hits = np.bincount(doc_index, weights=(weights != 0).astype(np.float64), minlength=count)
+    return np.tanh(sums / np.sqrt(np.maximum(hits, 1.0))).astype(np.float32)
+
+def label_scores(scores):
+    return np.where(scores >= SENTIMENT_THRESHOLD, "positive", np.where(scores <= -SENTIMENT_THRESHOLD, "negative", "neutral"))
+
+# Функция для процесса оценки: строки (id, score, label, model_version) для записи
+def score_chunk(ids, texts):
+    scores = score_texts(texts)
+    labels = label_scores(scores)
+    return [(review_id, round(float(score), 4), str(label), MODEL_VERSION) for review_id, score, label in zip(ids, scores, labels)]
+
+# Запись пачки одной транзакцией: оценки, приращение сумм только по реально вставленным строкам и сдвиг отметки
+def write_chunk(rows):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        inserted = execute_values(cursor, """
+            WITH inserted AS (
+                INSERT INTO review_sentiment (review_id, score, label, model_version)
+                VALUES %s
+                ON CONFLICT (review_id) DO NOTHING
+                RETURNING review_id, score, label
+            ), delta AS (
+                SELECT r.establishment_id,
+                       count(*) AS scored_count,
+                       sum(i.score) AS score_sum,
+                       count(*) FILTER (WHERE i.label = 'positive') AS positive_count,
+                       count(*) FILTER (WHERE i.label = 'negative') AS negative_count,
+                       count(*) FILTER (WHERE i.label = 'neutral') AS neutral_count
+                FROM inserted i
+                JOIN reviews r ON r.id = i.review_id
+                WHERE r.establishment_id IS NOT NULL
+                GROUP BY r.establishment_id
+            ), upserted AS (
+                INSERT INTO establishment_sentiment AS es
+                    (establishment_id, scored_count, score_sum, positive_count, negative_count, neutral_count)
+                SELECT establishment_id, scored_count, score_sum, positive_count, negative_count, neutral_count FROM delta
+                ON CONFLICT (establishment_id) DO UPDATE SET
+                    scored_count = es.scored_count + EXCLUDED.scored_count,
+                    score_sum = es.score_sum + EXCLUDED.score_sum,
+                    positive_count = es.positive_count + EXCLUDED.positive_count,
+                    negative_count = es.negative_count + EXCLUDED.negative_count,
+                    neutral_count = es.neutral_count + EXCLUDED.neutral_count,
+                    updated_at = now()
+            )
+            SELECT count(*) FROM inserted
+        """, rows, page_size=len(rows), fetch=True)
+        set_job_watermark(cursor, JOB_NAME, max(row[0] for row in rows))
+    return sum(count for (count,) in inserted)
+
+# Полный пересчёт: очистка оценок и сумм, отметка обнуляется (нужно после смены MODEL_VERSION)
+def reset_sentiment():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("TRUNCATE review_sentiment, establishment_sentiment")
+        cursor.execute("DELETE FROM job_watermarks WHERE job = %s", (JOB_NAME,))
+    log_print("Оценки тональности очищены, пересчёт начнётся с первого отзыва.")
+
+# Функция запуска задания: чтение серверным курсором, оценка в пуле процессов по порядку, запись пачками
+def run_sentiment(chunk_size, workers, rebuild=False):
+    setup_database()
+    reader = psycopg2.connect(**db_params)
+    executor = None
+    try:
+        cursor = reader.cursor()
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (SENTIMENT_LOCK_KEY,))
+        if not cursor.fetchone()[0]:
+            log_print("Оценка тональности уже выполняется другим процессом. Завершение работы.")
+            return
+        if rebuild:
+            reset_sentiment()
+        watermark = get_job_watermark(cursor, JOB_NAME)
+        cursor.execute("SELECT count(*) FROM review_sentiment WHERE model_version <> %s", (MODEL_VERSION,))
+        stale = cursor.fetchone()[0]
+        if stale:
+            log_print(f"WARNING: {stale} оценок сделаны другой версией модели; для пересчёта запустите с --rebuild.")
+        reader.commit()
+
+        # id выдаются до коммита, поэтому строки чуть ниже отметки могли появиться позже неё:
+        # перепроверяем окно SENTIMENT_LOOKBACK_IDS, уже оценённые отсекаются анти-джойном
+        lower_bound = max(0, watermark - SENTIMENT_LOOKBACK_IDS)
+        log_print(f"Оценка тональности ({MODEL_VERSION}): отметка {watermark}, чтение с id > {lower_bound}.")
+        rows_cursor = reader.cursor(name="sentiment_reader")
+        rows_cursor.itersize = chunk_size
+        rows_cursor.execute("""
+            SELECT r.id, r.review_text
+            FROM reviews r
+            LEFT JOIN review_sentiment s ON s.review_id = r.id
+            WHERE r.id > %s AND s.review_id IS NULL
+            ORDER BY r.id
+        """, (lower_bound,))
+
+        if workers > 0:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        pending = deque()
+        started = time.perf_counter()
+        scored = 0
+
+        def write(rows):
+            nonlocal scored
+            write_chunk(rows)
+            scored += len(rows)
+            elapsed = time.perf_counter() - started
+            log_print(f"Оценено отзывов: {scored}, {scored / elapsed:.0f} отзывов/с.")
+
+        while True:
+            chunk = rows_cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            ids = [row[0] for row in chunk]
+            texts = [row[1] for row in chunk]
+            if executor is None:
+                write(score_chunk(ids, texts))
+                continue
+            pending.append(executor.submit(score_chunk, ids, texts))
+            # Запись строго по порядку пачек, чтобы отметка не обгоняла неоценённые строки
+            while len(pending) >= workers * 2 or (pending and pending[0].done()):
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+        rows_cursor.close()
+
+        elapsed = time.perf_counter() - started
+        rate = scored / elapsed if elapsed > 0 else 0.0
+        log_print(f"Оценка тональности завершена: {scored} отзывов за {elapsed:.1f} с ({rate:.0f} отзывов/с).")
+        return scored
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        reader.close()
+        close_db_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description="Инкрементальная оценка тональности сохранённых отзывов")
+    parser.add_argument("--chunk-size", type=int, default=SENTIMENT_CHUNK_SIZE, help="Отзывов в одной пачке")
+    parser.add_argument("--workers", type=int, default=SENTIMENT_WORKERS, help="Процессов оценки, 0 — без пула")
+    parser.add_argument("--rebuild", action="store_true", help="Очистить оценки и пересчитать все отзывы")
+    args = parser.parse_args()
+    run_sentiment(args.chunk_size, args.workers, args.rebuild)
+
+if __name__ == "__main__":
+    main()